@@ -1,46 +1,111 @@
+import argparse
+import contextlib
 import csv
+import gzip
+import hashlib
+import io
 import json
 import os
+import sys
 import uuid
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from datetime import datetime
 
-continent_dtos = None
-subcontinent_dtos = None
-country_dtos = None
 
-region_dtos = None
-district_dtos = None
+def read_csv(path, delimiter=',', registry=None):
+    """
+    Returns the rows of the file as a lazy iterator together with the fieldnames.
+    The file is only opened while the rows are consumed, each row carries its uuid.
+    If a registry (external id -> uuid) is given, registered rows keep their uuid and new rows are added to it.
+    """
+    with open(path, 'r') as f:
+        fieldnames = list(csv.DictReader(f, delimiter=delimiter).fieldnames)
+    fieldnames.append('uuid')
+    return _read_rows(path, delimiter, registry), fieldnames
 
 
-def read_csv(path, delimiter=','):
+def _read_rows(path, delimiter, registry):
     with open(path, 'r') as f:
-        reader = csv.DictReader(f, delimiter=delimiter)
-        fieldnames = list(reader.fieldnames)
-        fieldnames.append('uuid')
-        result = list()
-        for line in reader:
-            keys = sorted(line.keys())
-            joined_values = ''.join([line[k] for k in keys])
-            _uuid = str(uuid.uuid5(uuid.NAMESPACE_URL, f'https://sormas.org/location/{joined_values}'))
+        for line in csv.DictReader(f, delimiter=delimiter):
+            external_id = line['externalID'] if 'externalID' in line else line.get('externalId')
+            _uuid = registry.get(external_id) if registry is not None and external_id else None
+            if _uuid is None:
+                keys = sorted(line.keys())
+                joined_values = ''.join([line[k] for k in keys])
+                _uuid = str(uuid.uuid5(uuid.NAMESPACE_URL, f'https://sormas.org/location/{joined_values}'))
+                if registry is not None and external_id:
+                    registry[external_id] = _uuid
             line['uuid'] = _uuid
 
-            result.append(line)
-        return result, fieldnames
+            yield line
+
+
+REGISTRY_PATH = './in/uuid_registry.csv'
+
+
+def load_registry(path=REGISTRY_PATH):
+    """
+    Reads the committed uuids as {level: {external id: uuid}}, the level being the name of the generation stage.
+    """
+    registry = defaultdict(dict)
+    if os.path.exists(path):
+        with open(path, 'r', newline='') as f:
+            for line in csv.DictReader(f):
+                registry[line['level']][line['externalID']] = line['uuid']
+    return registry
+
+
+def save_registry(registry, path=REGISTRY_PATH):
+    with open(path, 'w+', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['level', 'externalID', 'uuid'])
+        for level in sorted(registry):
+            for external_id, uuid_ in sorted(registry[level].items()):
+                writer.writerow([level, external_id, uuid_])
+
+
+def registry_digest(entries):
+    return hashlib.sha256(json.dumps(entries, sort_keys=True).encode()).hexdigest()
 
 
 def write_csv(out, path):
+    """
+    Writes each row as it passes through and yields it on, the file is complete once the rows are exhausted.
+    """
     out, fieldnames = out
     with open(path, 'w+', newline='') as csvfile:
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
         writer.writeheader()
         for line in out:
             writer.writerow(line)
+            yield line
 
 
 needs_ref_dto = {'region', 'district', 'country', 'subcontinent', 'continent'}
 
 
-def make_ref_dtos(out, key, dtos, filter_expr='name'):
+class InvalidReferenceError(Exception):
+    pass
+
+
+def collect_ref_index(dtos, index, key='name'):
+    # maps the lookup key of each parent to all uuids carrying it, duplicates are reported on lookup
+    for dto in dtos:
+        index[dto[key]].append(dto['uuid'])
+        yield dto
+
+
+def build_ref_index(dtos, key='name'):
+    index = defaultdict(list)
+    for _ in collect_ref_index(dtos, index, key):
+        pass
+    return index
+
+
+def make_ref_dtos(out, key, index, problems):
+    missing = defaultdict(int)
+    duplicates = dict()
     for needs_lookup in out:
         entity_name = needs_lookup[key]
         del needs_lookup[key]
@@ -50,90 +115,415 @@ def make_ref_dtos(out, key, dtos, filter_expr='name'):
         #if entity_name == 'Germany':
         #    entity_name = 'Deutschland'
 
-        candidate = list(filter(lambda f: f[filter_expr] == entity_name, dtos))
-        assert len(candidate) == 1
-        uuid = candidate[0]['uuid']
-        needs_lookup[key] = {'uuid': uuid}
-    return out
+        candidate = index.get(entity_name, [])
+        if len(candidate) != 1:
+            if candidate:
+                duplicates[entity_name] = candidate
+            else:
+                missing[entity_name] += 1
+            continue
+        needs_lookup[key] = {'uuid': candidate[0]}
+        yield needs_lookup
 
+    problems += [f"missing {key} '{name}' referenced by {count} row(s)" for name, count in missing.items()]
+    problems += [f"duplicate {key} '{name}': {', '.join(uuids)}" for name, uuids in duplicates.items()]
 
-def insert_ref_dtos(out):
-    dto_keys = set(out[0].keys())
-    ref_keys = dto_keys.intersection(needs_ref_dto)
-    if not ref_keys:
-        return out
 
-    if 'continent' in ref_keys:
-        out = make_ref_dtos(out, 'continent', continent_dtos, filter_expr='defaultName')
-    if 'subcontinent' in ref_keys:
-        out = make_ref_dtos(out, 'subcontinent', subcontinent_dtos, filter_expr='defaultName')
-    if 'country' in ref_keys:
-        out = make_ref_dtos(out, 'country', country_dtos, filter_expr='defaultName')
-    if 'region' in ref_keys:
-        out = make_ref_dtos(out, 'region', region_dtos)
-    if 'district' in ref_keys:
-        out = make_ref_dtos(out, 'district', district_dtos)
+def insert_ref_dtos(entities, ref_indexes):
+    out, fieldnames = entities
+    ref_keys = needs_ref_dto.intersection(fieldnames)
 
-    return out
+    problems = list()
+    for key in ('continent', 'subcontinent', 'country', 'region', 'district'):
+        if key in ref_keys:
+            out = make_ref_dtos(out, key, ref_indexes[key], problems)
 
+    yield from out
+    if problems:
+        raise InvalidReferenceError(f"Could not resolve {len(problems)} reference(s):\n\t" + '\n\t'.join(problems))
 
-def write_json(entities, path):
-    entities, fieldnames = entities
-    processed = insert_ref_dtos(entities)
 
-    out = list()
-    for p in processed:
+def coerce_archived(out):
+    for p in out:
         if 'archived' in p.keys():
             is_archived: str = p['archived']
             p['archived'] = False if (is_archived == '0' or is_archived.lower() == 'false') else True
-        p['changeDate'] = datetime.now().isoformat()
-        out.append({'key': p['uuid'], 'value': p})
-
+        yield p
+
+
+def record_digest(value):
+    # the changeDate is the result of the comparison, it must not be part of it
+    content = {k: v for k, v in value.items() if k != 'changeDate'}
+    return hashlib.sha256(json.dumps(content, sort_keys=True, ensure_ascii=False).encode('utf8')).hexdigest()[:16]
+
+
+COMPACT_FORMATS = {'ndjson': '.ndjson', 'gzip': '.ndjson.gz'}
+
+
+@contextlib.contextmanager
+def open_compact(path, compress=False):
+    """
+    Opens path for writing text, gzip-compressed if requested. Yields None if there is no path.
+    """
+    if not path:
+        yield None
+        return
+    with open(path, 'wb') as raw:
+        # no file name and a fixed mtime keep the archive byte-identical for identical content
+        binary = gzip.GzipFile(filename='', mode='wb', fileobj=raw, mtime=0) if compress else contextlib.nullcontext(raw)
+        with binary as binary:
+            text = io.TextIOWrapper(binary, encoding='utf8', newline='\n')
+            yield text
+            # hand the stream back instead of closing it, the surrounding blocks close it in order
+            text.flush()
+            text.detach()
+
+
+def write_json(entities, path, ref_indexes, previous_records=None, compact_path=None, compress=False):
+    """
+    Writes the {key, value} records one at a time and returns the manifest record of each by uuid: its digest,
+    changeDate, parent uuids and name. Records whose digest matches previous_records keep their previous changeDate.
+    The output is identical to a json.dump(indent=2) of the whole array, without holding the array in memory.
+    The manifest records are held though, one string per record, so the memory still grows with the number of rows.
+    If compact_path is given, the values are also written there as newline-delimited JSON, one record per line,
+    gzip-compressed if requested.
+    """
+    previous_records = previous_records or dict()
+    processed = coerce_archived(insert_ref_dtos(entities, ref_indexes))
+
+    records = dict()
+    with open(path, 'w+', encoding='utf8') as f, open_compact(compact_path, compress) as compact:
+        f.write('[')
+        for index, p in enumerate(processed):
+            digest = record_digest(p)
+            previous_digest, _, previous_change_date = previous_records.get(p['uuid'], '').partition(' ')
+            previous_change_date = previous_change_date.partition(' ')[0]
+            p['changeDate'] = previous_change_date if previous_digest == digest else datetime.now().isoformat()
+            records[p['uuid']] = manifest_record(p, digest)
+            element = json.dumps({'key': p['uuid'], 'value': p}, indent=2, ensure_ascii=False)
+            f.write(',\n  ' if index else '\n  ')
+            f.write(element.replace('\n', '\n  '))
+            if compact:
+                compact.write(json.dumps(p, ensure_ascii=False, separators=(',', ':')))
+                compact.write('\n')
+        f.write('\n]' if records else ']')
+    return records
+
+
+def output_paths(path, compact=None):
+    paths = [path + '.csv', path + '.json']
+    if compact:
+        paths.append(path + COMPACT_FORMATS[compact])
+    return paths
+
+
+def store(out, path, ref_indexes, previous_records=None, compact=None):
+    """
+    Streams the rows through all writers into temporary files, which replace the outputs only on success.
+    """
+    _, fieldnames = out
+    paths = output_paths(path, compact)
+    csv_tmp, json_tmp, compact_tmp = [p + '.tmp' for p in paths] + [None] * (3 - len(paths))
+    try:
+        records = write_json((write_csv(out, csv_tmp), fieldnames), json_tmp, ref_indexes, previous_records,
+                             compact_tmp, compact == 'gzip')
+    except Exception:
+        for p in paths:
+            if os.path.exists(p + '.tmp'):
+                os.remove(p + '.tmp')
+        raise
+    for p in paths:
+        os.replace(p + '.tmp', p)
+    return records
+
+
+MANIFEST_PATH = './out/manifest.json'
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def load_manifest(path=MANIFEST_PATH):
+    if not os.path.exists(path):
+        return dict()
+    with open(path, 'r', encoding='utf8') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, path=MANIFEST_PATH):
     with open(path, 'w+', encoding='utf8') as f:
-        json.dump(out, f, indent=2, ensure_ascii=False)
+        json.dump(manifest, f, indent=1, sort_keys=True, ensure_ascii=False)
+
+
+def manifest_record(value, digest):
+    # '<digest> <changeDate> <key>=<parent uuid>,... <name>', the delta compares the names and parents of two
+    # generations. One string per record, as the previous and the new records of a dataset are held in memory.
+    name = value['name'] if 'name' in value else value['defaultName']
+    parents = ','.join(f"{k}={v['uuid']}" for k, v in sorted(value.items()) if isinstance(v, dict))
+    return f"{digest} {value['changeDate']} {parents or '-'} {name}"
+
+
+def parse_record(record):
+    # the parents and the name of a manifest record
+    _, _, parents, name = record.split(' ', 3)
+    return dict(parent.split('=') for parent in parents.split(',') if parent != '-'), name
+
+
+def records_from_json(path):
+    # seeds the manifest from an already published file, so the first run does not touch every changeDate
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf8') as f:
+        return {e['key']: manifest_record(e['value'], record_digest(e['value'])) for e in json.load(f)}
 
 
-def store(out, path):
-    # todo Kosovo has empty UNO code
-    write_csv(out, path + '.csv')
-    write_json(out, path + '.json')
+def previous_manifest_records(entry, path):
+    # records of older manifests lack the parents and the name, they are seeded like a first run
+    if entry and all(isinstance(record, str) and record.count(' ') >= 3 for record in entry['records'].values()):
+        return entry['records']
+    return records_from_json(path)
+
+
+def compute_delta(previous, current):
+    """
+    Compares the manifest records of two generations matched by uuid.
+    """
+    delta = {'added': sorted(current.keys() - previous.keys()), 'removed': sorted(previous.keys() - current.keys()),
+             'renamed': [], 'reparented': []}
+    for uuid_ in sorted(current.keys() & previous.keys()):
+        old, new = previous[uuid_].split(' ', 2)[2], current[uuid_].split(' ', 2)[2]
+        if old == new:
+            continue
+        (old_parents, old_name), (new_parents, new_name) = parse_record(previous[uuid_]), parse_record(current[uuid_])
+        if old_name != new_name:
+            delta['renamed'].append({'uuid': uuid_, 'from': old_name, 'to': new_name})
+        if old_parents != new_parents:
+            delta['reparented'].append({'uuid': uuid_, 'from': old_parents, 'to': new_parents})
+    return delta
+
+
+def write_delta(delta, path):
+    with open(path, 'w+', encoding='utf8') as f:
+        json.dump(delta, f, indent=2, ensure_ascii=False)
+
+
+# the generation stages form a DAG: parents maps each reference column to the stage whose index resolves it
+STAGES = {
+    'international/continent': {
+        'input': './in/international/sormas_import_all_continents.csv', 'delimiter': ',',
+        'parents': {}, 'index_key': 'defaultName',
+    },
+    'international/subcontinent': {
+        'input': './in/international/sormas_import_all_subcontinents.csv', 'delimiter': ',',
+        'parents': {'continent': 'international/continent'}, 'index_key': 'defaultName',
+    },
+    'international/sormas_import_all_countries': {
+        'input': './in/international/sormas_import_all_countries.csv', 'delimiter': ',',
+        'parents': {'subcontinent': 'international/subcontinent'}, 'index_key': None,
+    },
+    'germany/country': {
+        'input': './in/germany/sormas_laender_survnet.csv', 'delimiter': ';',
+        'parents': {'subcontinent': 'international/subcontinent'}, 'index_key': 'defaultName',
+    },
+    'germany/region': {
+        'input': './in/germany/sormas_bundeslaender_master.csv', 'delimiter': ';',
+        'parents': {'country': 'germany/country'}, 'index_key': 'name',
+    },
+    'germany/district': {
+        'input': './in/germany/sormas_landkreise_master.csv', 'delimiter': ';',
+        'parents': {'region': 'germany/region'}, 'index_key': 'name',
+    },
+    'germany/community': {
+        'input': './in/germany/sormas_gemeinden_master.csv', 'delimiter': ';',
+        'parents': {'region': 'germany/region', 'district': 'germany/district'}, 'index_key': None,
+    },
+}
+
+
+def generate(name, stage, ref_indexes, parent_digests, entry, registry, force=False, compact=None):
+    """
+    Stores the dataset of the stage unless neither its input file, its registered uuids nor any of its parents changed
+    since the last run. The input digest chains parent_digests, as a changed parent changes the references of its
+    children. registry holds the uuids of the stage by external id, rows not registered yet are added to it.
+    Returns the reference index of the dataset (if the stage has an index_key), its new manifest entry and registry.
+    The changes against the records of the manifest are written to <dataset>.delta.json. A skipped stage, or one
+    whose records did not change, keeps the pending delta of its last regeneration.
+    """
+    out_path = os.path.join(os.path.dirname(MANIFEST_PATH), name)
+    rows, fieldnames = read_csv(stage['input'], stage['delimiter'], registry)
+    unresolvable = needs_ref_dto.intersection(fieldnames).difference(ref_indexes)
+    if unresolvable:
+        raise InvalidReferenceError(f"{name}: no parent stage declared for {', '.join(sorted(unresolvable))}")
+
+    index = defaultdict(list)
+    if stage['index_key']:
+        rows = collect_ref_index(rows, index, stage['index_key'])
+
+    def input_digest():
+        h = hashlib.sha256(file_digest(stage['input']).encode())
+        h.update(registry_digest(registry).encode())
+        for parent_digest in parent_digests:
+            h.update(parent_digest.encode())
+        return h.hexdigest()
+
+    outputs_present = all(os.path.exists(p) for p in output_paths(out_path, compact))
+    if not force and entry and entry['input'] == input_digest() and outputs_present:
+        print(f"{name}: input unchanged, skipping")
+        if stage['index_key']:
+            for _ in rows:
+                pass
+        return index, entry, registry
+
+    previous_records = previous_manifest_records(entry, out_path + '.json')
+    records = store((rows, fieldnames), out_path, ref_indexes, previous_records, compact)
+    changed = sum(1 for uuid_, record in records.items() if previous_records is None or previous_records.get(uuid_) != record)
+    removed = len(previous_records.keys() - records.keys()) if previous_records else 0
+
+    delta_path = out_path + '.delta.json'
+    if changed or removed or not os.path.exists(delta_path):
+        delta = compute_delta(previous_records or dict(), records)
+        write_delta(delta, delta_path)
+        print(f"{name}: wrote {len(records)} records, {changed} changed "
+              f"({', '.join(f'{len(v)} {k}' for k, v in delta.items())})")
+    else:
+        # e.g. --force or a new --compact format, the delta not aligned yet must survive
+        print(f"{name}: wrote {len(records)} records, none changed, keeping the pending delta")
+    # digested after the run, so the uuids registered by this run do not count as a change next time
+    return index, {'input': input_digest(), 'records': records}, registry
+
+
+def run_stages(stages, manifest, registry, force=False, jobs=None, compact=None):
+    """
+    Runs every stage on a process pool as soon as all of its parents are done.
+    Each stage receives the indexes and digests of its own parents and its own level of the registry only,
+    the manifest and the registry are updated in place.
+    """
+    indexes = dict()
+    remaining = dict(stages)
+    pending = dict()
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        while remaining or pending:
+            ready = [name for name, stage in remaining.items() if set(stage['parents'].values()).issubset(indexes)]
+            if not ready and not pending:
+                raise Exception(f"Stages {', '.join(remaining)} depend on unknown or cyclic parents")
+            for name in ready:
+                stage = remaining.pop(name)
+                ref_indexes = {key: indexes[parent] for key, parent in stage['parents'].items()}
+                parent_digests = [manifest[parent]['input'] for parent in sorted(set(stage['parents'].values()))]
+                future = pool.submit(generate, name, stage, ref_indexes, parent_digests, manifest.get(name),
+                                     registry[name], force, compact)
+                pending[future] = name
+
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = pending.pop(future)
+                indexes[name], manifest[name], registry[name] = future.result()
+    return indexes
+
+
+def stage_order(stages):
+    # parents before children, in declaration order otherwise
+    ordered = list()
+    remaining = dict(stages)
+    while remaining:
+        ready = [name for name, stage in remaining.items() if set(stage['parents'].values()).issubset(ordered)]
+        if not ready:
+            raise Exception(f"Stages {', '.join(remaining)} depend on unknown or cyclic parents")
+        for name in ready:
+            ordered.append(name)
+            del remaining[name]
+    return ordered
+
+
+def validate(stages, registry):
+    """
+    Checks the whole hierarchy in one pass over the inputs, without writing anything: duplicate uuids across all
+    stages, duplicate or empty external ids and empty names within a stage, empty ISO/UNO codes and references to
+    missing or ambiguous parents. Returns {stage: {check: [findings]}} with the input line of every finding.
+    """
+    report = defaultdict(lambda: defaultdict(list))
+    indexes = dict()
+    uuids = dict()
+    for name in stage_order(stages):
+        stage = stages[name]
+        # a copy, validating must not register new uuids
+        rows, fieldnames = read_csv(stage['input'], stage['delimiter'], dict(registry[name]))
+        refs = {key: indexes[parent] for key, parent in stage['parents'].items()}
+        ref_keys = needs_ref_dto.intersection(fieldnames)
+        for key in ref_keys.difference(refs):
+            report[name]['undeclared parent'].append({'column': key})
+        codes = [code for code in ('isoCode', 'unoCode') if code in fieldnames]
+        name_key = 'name' if 'name' in fieldnames else 'defaultName'
+
+        external_ids = dict()
+        index = indexes[name] = defaultdict(list)
+        for line, row in enumerate(rows, start=2):
+            uuid_, external_id = row['uuid'], row['externalID'] if 'externalID' in row else row.get('externalId')
+            if uuid_ in uuids:
+                report[name]['duplicate uuid'].append({'line': line, 'uuid': uuid_, 'first': uuids[uuid_]})
+            else:
+                uuids[uuid_] = f'{name}:{line}'
+            if not external_id:
+                report[name]['empty external id'].append({'line': line, 'name': row[name_key]})
+            elif external_id in external_ids:
+                report[name]['duplicate external id'].append({'line': line, 'externalID': external_id,
+                                                              'first': external_ids[external_id]})
+            else:
+                external_ids[external_id] = line
+            if not row[name_key]:
+                report[name]['empty name'].append({'line': line, 'uuid': uuid_})
+            for code in codes:
+                if not row[code]:
+                    report[name][f'empty {code}'].append({'line': line, 'name': row[name_key]})
+            for key in ref_keys.intersection(refs):
+                candidates = refs[key].get(row[key], [])
+                if len(candidates) != 1:
+                    check = 'ambiguous parent' if candidates else 'orphaned parent'
+                    report[name][check].append({'line': line, key: row[key], 'candidates': candidates})
+            if stage['index_key']:
+                index[row[stage['index_key']]].append(uuid_)
+    return {name: dict(checks) for name, checks in report.items()}
+
+
+def print_report(report):
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    summary = [f"{name}: {len(findings)} {check}" for name, checks in report.items() for check, findings in checks.items()]
+    print('\n'.join(summary) if summary else 'No problems found')
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--force", default=os.environ.get("FORCE") == 'true', action="store_true",
+                        help="regenerate all outputs even if their inputs did not change")
+    parser.add_argument("-j", "--jobs", default=os.environ.get("JOBS"), type=int,
+                        help="number of worker processes, defaults to the number of CPUs")
+    parser.add_argument("-c", "--compact", default=os.environ.get("COMPACT"), choices=list(COMPACT_FORMATS),
+                        help="additionally write newline-delimited JSON (ndjson), optionally gzip-compressed (gzip)")
+    parser.add_argument("-V", "--validate", action="store_true",
+                        help="only validate the input data and print the report, e.g. as a pre-commit check")
+    args = parser.parse_args()
+
     #os.mkdir("./out/")
     #os.mkdir("./out/international")
     #os.mkdir("./out/germany")
-    int_continents = read_csv('./in/international/sormas_import_all_continents.csv', ',')
-    global continent_dtos
-    continent_dtos = int_continents[0]
-    store(int_continents, './out/international/continent')
-
-    int_subcontinents = read_csv('./in/international/sormas_import_all_subcontinents.csv', ',')
-    global subcontinent_dtos
-    subcontinent_dtos = int_subcontinents[0]
-    store(int_subcontinents, './out/international/subcontinent')
-
-    int_countries = read_csv('./in/international/sormas_import_all_countries.csv', ',')
-    store(int_countries, './out/international/sormas_import_all_countries')
-
-    int_countries = read_csv('./in/germany/sormas_laender_survnet.csv', ';')
-    global country_dtos
-    country_dtos = int_countries[0]
-    store(int_countries, './out/germany/country')
-
-    int_regions = read_csv('./in/germany/sormas_bundeslaender_master.csv', ';')
-    global region_dtos
-    region_dtos = int_regions[0]
-    store(int_regions, './out/germany/region')
-
-    int_districts = read_csv('./in/germany/sormas_landkreise_master.csv', ';')
-    global district_dtos
-    district_dtos = int_districts[0]
-    store(int_districts, './out/germany/district')
-
-    int_communities = read_csv('./in/germany/sormas_gemeinden_master.csv', ';')
-    store(int_communities, './out/germany/community')
-    pass
+    registry = load_registry()
+    report = validate(STAGES, registry)
+    if args.validate or report:
+        print_report(report)
+    if report:
+        sys.exit(1)
+    if args.validate:
+        return
+
+    manifest = load_manifest()
+    run_stages(STAGES, manifest, registry, force=args.force, jobs=args.jobs, compact=args.compact)
+    save_registry(registry)
+    save_manifest(manifest)
 
 
 if __name__ == '__main__':
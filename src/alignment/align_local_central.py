@@ -1,29 +1,28 @@
+from __future__ import annotations
+
 import os
+import sys
 
-import psycopg
 import json
+import hashlib
 import argparse
+import queue
+import threading
 
 from psycopg.errors import UniqueViolation
 from psycopg.rows import dict_row
 
 import logging
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
-error_list = []
-
-FORMAT = '%(message)s'
-
-logFormatter = logging.Formatter(FORMAT)
-rootLogger = logging.getLogger()
-
-fileHandler = logging.FileHandler("output.log")
-fileHandler.setFormatter(logFormatter)
-rootLogger.addHandler(fileHandler)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from infra_store import CENTRAL_PATHS, InfraStore, load_central
+from audit_log import event, setup_audit_log
+from run_metrics import connect, phase, setup_run_metrics
 
-consoleHandler = logging.StreamHandler()
-consoleHandler.setFormatter(logFormatter)
-rootLogger.addHandler(consoleHandler)
-rootLogger.setLevel(logging.DEBUG)
+error_list = []
+manual_cleanup_list = []
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-H", "--host", default=os.environ.get("host"), help="database server host or socket directory",
@@ -44,11 +43,45 @@ parser.add_argument("-a", "--archive", default=os.environ.get("ARCHIVE"), help="
 parser.add_argument("-t", "--test", default=os.environ.get("test"), help="test mode/dry run", action="store")
 parser.add_argument("-c", "--community", default=os.environ.get("community"), help="handle communities true/false",
                     action="store")
+parser.add_argument("-D", "--delta", default=os.environ.get("delta"),
+                    help="only align the rows listed in the <table>.delta.json next to the central data",
+                    action="store")
+parser.add_argument("-T", "--targeted", default=os.environ.get("targeted"),
+                    help="instead of archiving everything up front, only archive the local items left without central "
+                         "counterpart after aligning, true/false", action="store")
+parser.add_argument("-X", "--create-indexes", default=os.environ.get("create_indexes"),
+                    help="create the indexes the row engine lookups lack for the duration of the run, true/false",
+                    action="store")
+parser.add_argument("-e", "--engine", default=os.environ.get("engine", "row"), choices=['row', 'set', 'snapshot'],
+                    help="align row by row, with joins against a temp table of the central data or against an "
+                         "in-memory snapshot of the local table", action="store")
+parser.add_argument("-C", "--command", default=os.environ.get("command", "align"), choices=['align', 'plan', 'apply'],
+                    help="align directly, only write the alignment plan or apply a written plan", action="store")
+parser.add_argument("-f", "--plan", default=os.environ.get("plan", "plan.json"),
+                    help="path of the alignment plan written by plan and read by apply", action="store")
+parser.add_argument("-k", "--checkpoint", default=os.environ.get("checkpoint", "checkpoint.json"),
+                    help="path of the checkpoint a restarted alignment continues from", action="store")
+parser.add_argument("-n", "--chunk-size", default=os.environ.get("chunk_size", 500), type=int,
+                    help="number of central items the row engine aligns per commit", action="store")
+parser.add_argument("-w", "--workers", default=os.environ.get("workers", 1), type=int,
+                    help="number of connections aligning the communities of independent districts in parallel",
+                    action="store")
+parser.add_argument("-l", "--audit-log", default=os.environ.get("audit_log", "audit.jsonl"),
+                    help="path of the JSON lines audit log", action="store")
+parser.add_argument("-m", "--metrics", default=os.environ.get("metrics"),
+                    help="path of the run metrics, a Prometheus textfile if it ends with .prom, JSON otherwise",
+                    action="store")
+parser.add_argument("-b", "--batch-size", default=os.environ.get("batch_size", 1000), type=int,
+                    help="number of statements sent per executemany", action="store")
 
 args, unknown = parser.parse_known_args()
 
 assert len(unknown) == 0
 
+setup_audit_log(args.audit_log, 'errors.log')
+setup_run_metrics(args.metrics, script='align_local_central', host=args.host, dbname=args.dbname, engine=args.engine,
+                  command=args.command)
+
 CONNECTION = f"host={args.host} dbname={args.dbname} user={args.username} password={args.password} port={args.port}"
 logging.info(f'Connecting to {args.host}')
 PATH = args.input
@@ -56,184 +89,873 @@ BAVARIAN_MODE = args.bavarian == 'true'
 ARCHIVE_ON_CONFLICT = args.archive == 'true'
 DRY_RUN = args.test == "true"
 HANDLE_COMMUNITIES = args.community == 'true'
-
-NUMBER_OF_NAMES: dict[str, int] = {}
+USE_DELTA = args.delta == 'true'
+TARGETED_ARCHIVE = args.targeted == 'true'
+CREATE_INDEXES = args.create_indexes == 'true'
+ENGINE = args.engine
+BATCH_SIZE = args.batch_size
+COMMAND = args.command
+PLAN_PATH = args.plan
+CHECKPOINT_PATH = args.checkpoint
+CHUNK_SIZE = args.chunk_size
+WORKERS = args.workers
+
+NUMBER_OF_NAMES: Counter[str] = Counter()
+# tables referencing communities, in the order they decide which of several duplicates survives
+REFERENCING_TABLES = ['facility', 'cases', 'contact', 'users']
+COMMUNITY_REFERENCES: dict[int, dict[str, int]] = {}
+# per central uuid, the survivor bavarian mode chose up front among its local duplicates and the table deciding it
+BAVARIAN_GROUPS: dict[str, dict] = {}
+# the uuids of all central communities, a duplicate carrying one of them is not available as survivor
+CENTRAL_UUIDS: set[str] = set()
+# per table, the local items whose update was skipped because they held the central values already
+UNCHANGED: Counter[str] = Counter()
+UNCHANGED_LOCK = threading.Lock()
+# per table, the uuids of local items whose uuid matched but whose name and external id both failed the sanity check
+SANITY_FAILURES: dict[str, set[str]] = defaultdict(set)
+SANITY_LOCK = threading.Lock()
+TEMP_INDEX_PREFIX = 'align_tmp_'
+TEMP_INDEX_LIKE = 'align\\_tmp\\_%'
+
+
+def disable_infrastructure_editing(cur):
+    cur.execute("UPDATE featureconfiguration SET enabled=FALSE "
+                "WHERE featuretype='EDIT_INFRASTRUCTURE_DATA' AND enabled IS NOT FALSE;")
+
+
+def archive_everything(table, conn):
+    if DRY_RUN:
+        return
+    logging.info(f"Archive {table}")
+    with conn.cursor(row_factory=dict_row) as cur:
+        disable_infrastructure_editing(cur)
+        cur.execute(f"UPDATE {table} SET archived=TRUE WHERE TRUE;")
 
 
-def archive_everything(table):
+def archive_removed(table, uuids: list[str], conn):
     if DRY_RUN:
         return
-    logging.info(f"Archive {table}")
-    with psycopg.connect(CONNECTION) as conn:
-        with conn.cursor(row_factory=dict_row) as cur:
-            cur.execute("UPDATE featureconfiguration SET enabled=FALSE WHERE featuretype='EDIT_INFRASTRUCTURE_DATA';")
-            cur.execute(f"UPDATE {table} SET archived=TRUE WHERE TRUE;")
+    logging.info(f"Archive {len(uuids)} listed items of {table}")
+    with conn.cursor(row_factory=dict_row) as cur:
+        disable_infrastructure_editing(cur)
+        cur.execute(f"UPDATE {table} SET archived=TRUE WHERE uuid = ANY(%s);", (uuids,))
 
 
-def compute_community_names(table, items):
+def archive_unmatched(table, values: list[dict], conn):
+    """
+    Archives the local items not carrying the uuid of any central item once aligning is done, in one statement.
+    Aligned items are written once instead of being archived and de-archived again. Items matched by uuid that failed
+    the sanity check were not aligned, they are archived as well.
+    """
+    if DRY_RUN:
+        return
+    with SANITY_LOCK:
+        insane = sorted(SANITY_FAILURES[table])
+    with conn.cursor() as cur:
+        disable_infrastructure_editing(cur)
+        cur.execute(f"UPDATE {table} SET archived=TRUE WHERE archived IS NOT TRUE "
+                    f"AND (uuid <> ALL(%s) OR uuid = ANY(%s));", ([value['uuid'] for value in values], insane))
+        logging.info(f"Archived {cur.rowcount} items of {table} without central counterpart or failing the sanity "
+                     f"check")
+
+
+def read_delta(path) -> tuple[set[str], list[str]]:
+    # the delta written by main.py next to the central data: the uuids to align and the uuids to archive
+    with open(path.removesuffix('.json') + '.delta.json') as f:
+        delta: dict[str, list] = json.load(f)
+    touched = set(delta['added'])
+    touched.update(item['uuid'] for item in delta['renamed'])
+    touched.update(item['uuid'] for item in delta['reparented'])
+    return touched, delta['removed']
+
+
+def compute_community_names(table, store: InfraStore):
     if table != "community":
         return
 
     # compute the numbers of names for each community
-    for item in items:
-        name = item['value']['name']
-        if name in NUMBER_OF_NAMES:
-            NUMBER_OF_NAMES[name] += 1
-        else:
-            NUMBER_OF_NAMES[name] = 1
+    NUMBER_OF_NAMES.update(store.names())
 
 
-def warn_about_missing_communities(table, central_value: dict[str, str]):
-    if table != "community":
+def count_local_community_names(conn) -> Counter[str]:
+    with conn.cursor() as cur:
+        return Counter(dict(cur.execute("SELECT name, count(*) FROM community GROUP BY name;").fetchall()))
+
+
+def warn_about_missing_communities(local: Counter[str]):
+    """
+    Reports every community name present less or more often locally than centrally.
+    """
+    missing, excess = NUMBER_OF_NAMES - local, local - NUMBER_OF_NAMES
+    if not missing and not excess:
+        logging.info("Number of every community name matches central")
         return
-    with psycopg.connect(CONNECTION) as conn:
-        with conn.cursor(row_factory=dict_row) as cur:
-            # count the number of communities with central_value name
-            name_: str = central_value['name']
-            cur.execute("SELECT count(*) FROM community WHERE name=%s;", (name_,))
-            count: int = cur.fetchone()['count']
-            central_number = NUMBER_OF_NAMES[name_]
-            if count != central_number:
-                report_error(f"Number of community name {name_} differs: Central {central_number}, Local {count}")
-
-
-def iterate_central():
+    report_error(f"Number of community names differs: {sum(missing.values())} missing in {len(missing)} names, "
+                 f"{sum(excess.values())} in excess in {len(excess)} names")
+    for name_ in sorted(missing):
+        report_error(f"\tMissing community name {name_}: Central {NUMBER_OF_NAMES[name_]}, Local {local[name_]}")
+    for name_ in sorted(excess):
+        report_error(f"\tExcess community name {name_}: Central {NUMBER_OF_NAMES[name_]}, Local {local[name_]}")
+
+
+def infra_types() -> list[str]:
     if DRY_RUN:
-        infra_types = {
-            'continent': f'{PATH}/international/continent.json',
-            'subcontinent': f'{PATH}/international/subcontinent.json',
-            'country': f'{PATH}/germany/country.json',
-            'region': f'{PATH}/germany/region.json',
-            'district': f'{PATH}/germany/district.json',
-            'community': f'{PATH}/germany/community.json'
-        }
+        return ['continent', 'subcontinent', 'country', 'region', 'district', 'community']
     elif HANDLE_COMMUNITIES:
-        infra_types = {
-            'community': f'{PATH}/germany/community.json'
-        }
+        return ['community']
     else:
-        infra_types = {
-            'continent': f'{PATH}/international/continent.json',
-            'subcontinent': f'{PATH}/international/subcontinent.json',
-            'country': f'{PATH}/germany/country.json',
-            'region': f'{PATH}/germany/region.json',
-            'district': f'{PATH}/germany/district.json'
-        }
-
-    for table, path in infra_types.items():
+        return ['continent', 'subcontinent', 'country', 'region', 'district']
+
+
+def lookup_columns(table) -> list[str]:
+    columns = ['uuid', 'defaultname' if has_default_name(table) else 'name', 'externalid']
+    return columns + ['isocode', 'unocode'] if table == "country" else columns
+
+
+def find_unindexed_columns(tables: list[str], conn) -> dict[str, list[str]]:
+    """
+    Returns the lookup columns of tables not leading any valid, non-partial index. The catalog behind pg_indexes is
+    read directly, so the leading column need not be parsed from the index definition.
+    Temporary indexes of an interrupted run do not count.
+    """
+    with conn.cursor() as cur:
+        indexed = set(cur.execute(
+            "SELECT t.relname, a.attname FROM pg_index i "
+            "JOIN pg_class t ON t.oid = i.indrelid JOIN pg_class x ON x.oid = i.indexrelid "
+            "JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0] "
+            "WHERE t.relnamespace = current_schema()::regnamespace AND t.relname = ANY(%s) "
+            "AND i.indisvalid AND i.indpred IS NULL AND x.relname NOT LIKE %s;",
+            (tables, TEMP_INDEX_LIKE)).fetchall())
+    unindexed = {}
+    for table in tables:
+        columns = [column for column in lookup_columns(table) if (table, column) not in indexed]
+        if columns:
+            unindexed[table] = columns
+    return unindexed
+
+
+def create_temporary_indexes(unindexed: dict[str, list[str]], conn) -> list[str]:
+    """
+    Creates an index for every unindexed lookup column without locking out writes, and returns their names.
+    The connection is in autocommit mode, CREATE INDEX CONCURRENTLY cannot run in a transaction.
+    """
+    names = []
+    with conn.cursor() as cur:
+        # leftovers of an interrupted run, possibly invalid
+        for (name,) in cur.execute("SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() "
+                                   "AND indexname LIKE %s;",
+                                   (TEMP_INDEX_LIKE,)).fetchall():
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+        for table, columns in unindexed.items():
+            for column in columns:
+                name = f"{TEMP_INDEX_PREFIX}{table}_{column}"
+                logging.info(f"Create temporary index {name}")
+                cur.execute(f"CREATE INDEX CONCURRENTLY {name} ON {table} ({column});")
+                names.append(name)
+    return names
+
+
+def drop_temporary_indexes(names: list[str], conn):
+    with conn.cursor() as cur:
+        for name in names:
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+    if names:
+        logging.info(f"Dropped {len(names)} temporary indexes")
+
+
+def preflight_indexes(conn) -> list[str]:
+    """
+    Warns about the lookup columns of the row engine without index and, with CREATE_INDEXES, creates temporary
+    indexes for them. Returns the names of the indexes to drop after the run.
+    """
+    # the set and snapshot engines join or scan whole tables, only the row engine looks up single items
+    if ENGINE != 'row' or COMMAND != 'align':
+        return []
+    unindexed = find_unindexed_columns(infra_types(), conn)
+    for table, columns in unindexed.items():
+        logging.warning(f"No index on {', '.join(columns)} of {table}, every lookup by them scans the whole table")
+    if not unindexed or not CREATE_INDEXES or DRY_RUN:
+        return []
+    with phase('indexes'):
+        return create_temporary_indexes(unindexed, conn)
+
+
+def iterate_central(conn) -> dict:
+    plan = {}
+    checkpoint = load_checkpoint()
+    for table in infra_types():
         logging.info(f"Process table {table}")
-        with open(path) as f:
-            entities: list = json.load(f)
+        with phase('load', table):
+            store = load_central(PATH, table)
+        l = list(store)
+
+        compute_community_names(table, store)
+
+        archive = 'unmatched' if TARGETED_ARCHIVE else 'all'
+        if USE_DELTA:
+            # STEP 1: only archive what was removed centrally and only align what was added or changed
+            touched, archive = read_delta(f'{PATH}/{CENTRAL_PATHS[table]}')
+            l = [store.get(uuid_) for uuid_ in sorted(touched)]
+
+        if table == "community" and BAVARIAN_MODE:
+            with phase('references', table):
+                resolve_bavarian_groups(l, store.by_uuid.keys(), conn)
+
+        if COMMAND == 'plan':
+            # the matching runs on a snapshot, archiving and updates are only recorded
+            with phase('plan', table, items=len(l)), conn.transaction():
+                plan[table] = plan_table(table, l, archive, conn)
+            continue
+
+        progress = table_progress(checkpoint, table, l, archive)
+        if progress.get('done'):
+            logging.info(f"Skip {table}, it is aligned according to {CHECKPOINT_PATH}")
+            continue
+
+        if ENGINE == 'row':
+            align_rows_chunked(table, l, archive, progress, checkpoint, conn)
+        else:
+            # the table is aligned atomically, a failure rolls back its archiving as well
+            with conn.transaction():
+                with phase('archive', table):
+                    archive_table(table, archive, conn)
+
+                with phase('align', table, items=len(l)):
+                    if ENGINE == 'snapshot':
+                        # STEP 2: match against an in-memory copy of the local table and write the result back in
+                        # batches
+                        align_snapshot(table, l, conn)
+                    else:
+                        # STEP 2: match all central items at once, only the ambiguous ones are left to the row engine
+                        align_rows(table, align_set(table, l, conn), conn)
+                        if table == "community":
+                            with phase('check', table):
+                                warn_about_missing_communities(count_local_community_names(conn))
+
+                if archive == 'unmatched':
+                    with phase('archive', table):
+                        archive_unmatched(table, l, conn)
+
+        logging.info(f"Skipped {UNCHANGED[table]} updates of {table}, the local items held the central values already")
+        progress['done'] = True
+        save_checkpoint(checkpoint)
+
+    # everything is aligned, the next run starts from scratch. A plan leaves the progress of an interrupted alignment.
+    if COMMAND == 'align' and os.path.exists(CHECKPOINT_PATH) and not DRY_RUN:
+        os.remove(CHECKPOINT_PATH)
+    return plan
+
+
+def archive_table(table, archive: str | list[str], conn):
+    if archive == 'all':
         # STEP 1: invalidate ALL present data and prevent user from interfering
-        archive_everything(table)
+        archive_everything(table, conn)
+    elif archive == 'unmatched':
+        # STEP 1: only prevent user from interfering, archive_unmatched follows the alignment
+        if not DRY_RUN:
+            with conn.cursor() as cur:
+                disable_infrastructure_editing(cur)
+    else:
+        archive_removed(table, archive, conn)
+
+
+def align_rows(table, values: list[dict], conn, offset=0, length=None):
+    length = length or len(values)
+    for index, central_value in enumerate(values, offset):
+        central_value: dict[str, str | dict[str]] = central_value
+        name: str = central_value['defaultName'] if has_default_name(table) else central_value['name']
+        id_: str = central_value['externalId'] if central_value.get('externalId') else central_value['externalID']
+        uuid_: str = central_value['uuid']
+        logging.info(f"{index + 1}/{length}: Processing {name}, {id_}, {uuid_}",
+                     extra=event('processing', table=table, index=index + 1, total=length, uuid=uuid_))
 
-        l = list(sorted(entities, key=lambda kv: kv['key']))
-        length = len(l)
+        align_row(table, central_value, conn)
 
-        compute_community_names(table, l)
 
-        for index, entity in enumerate(l):
-            entity: dict[str, str | dict[str]] = entity
-            central_value: dict[str | str] = entity['value']
-            name: str = central_value['defaultName'] if has_default_name(table) else central_value['name']
-            id_: str = central_value['externalId'] if central_value.get('externalId') else central_value['externalID']
-            uuid_: str = central_value['uuid']
-            logging.info(f"{index + 1}/{length}: Processing {name}, {id_}, {uuid_}")
+def load_checkpoint() -> dict:
+    if DRY_RUN or not os.path.exists(CHECKPOINT_PATH):
+        return {}
+    with open(CHECKPOINT_PATH, encoding='utf8') as f:
+        return json.load(f)
 
-            warn_about_missing_communities(table, central_value)
 
-            # STEP 2: check if central item is locally present by uuid
-            if update_by_local_uuid(table, central_value):
+def save_checkpoint(checkpoint: dict):
+    if DRY_RUN:
+        return
+    with SANITY_LOCK:
+        # archive_unmatched still needs them after a restart
+        for table, uuids in SANITY_FAILURES.items():
+            if table in checkpoint:
+                checkpoint[table]['sanity_failures'] = sorted(uuids)
+    with open(CHECKPOINT_PATH + '.tmp', 'w+', encoding='utf8') as f:
+        json.dump(checkpoint, f, indent=1, sort_keys=True)
+    os.replace(CHECKPOINT_PATH + '.tmp', CHECKPOINT_PATH)
+
+
+def table_progress(checkpoint: dict, table, values: list[dict], archive: str | list[str]) -> dict:
+    """
+    Returns the progress of table stored in the checkpoint, or a fresh one if the central data or the archiving to
+    perform changed since it was written.
+    """
+    digest = hashlib.sha256(json.dumps([archive, values], sort_keys=True).encode('utf8')).hexdigest()[:16]
+    progress = checkpoint.get(table)
+    if progress is None or progress['plan'] != digest:
+        progress = checkpoint[table] = {'plan': digest}
+    SANITY_FAILURES[table].update(progress.get('sanity_failures', []))
+    return progress
+
+
+def align_rows_chunked(table, values: list[dict], archive: str | list[str], progress: dict, checkpoint: dict, conn):
+    """
+    Row engine committing every CHUNK_SIZE items. The checkpoint records the archiving and the uuid of the last
+    committed item, a restart continues right after it.
+    """
+    if not progress.get('archived'):
+        with phase('archive', table), conn.transaction():
+            archive_table(table, archive, conn)
+        progress['archived'] = True
+        save_checkpoint(checkpoint)
+
+    central = values
+    if table == "community" and WORKERS > 1:
+        # districts not interacting with each other are aligned in parallel, the rest serially below
+        with phase('align_parallel', table, items=len(values)):
+            values = align_partitions(table, values, progress, checkpoint, conn)
+
+    # the central items are sorted by uuid, so the last committed uuid separates done from pending items
+    last_uuid = progress.get('last_uuid')
+    pending = [value for value in values if last_uuid is None or value['uuid'] > last_uuid]
+    if last_uuid:
+        logging.info(f"Resume {table} after {last_uuid}, {len(values) - len(pending)} items are aligned already")
+
+    with phase('align', table, items=len(pending)):
+        for start in range(0, len(pending), CHUNK_SIZE):
+            chunk = pending[start:start + CHUNK_SIZE]
+            with conn.transaction():
+                align_rows(table, chunk, conn, len(values) - len(pending) + start, len(values))
+            progress['last_uuid'] = chunk[-1]['uuid']
+            save_checkpoint(checkpoint)
+
+    if archive == 'unmatched':
+        # repeated after a restart, it only archives what is still unarchived
+        with phase('archive', table), conn.transaction():
+            archive_unmatched(table, central, conn)
+
+    if table == "community":
+        with phase('check', table):
+            warn_about_missing_communities(count_local_community_names(conn))
+
+
+def partition_communities(values: list[dict], conn) -> tuple[dict[str, list[dict]], list[dict]]:
+    """
+    Splits the central communities by district. Items connected by uuid, name or external id, directly or through
+    local rows, to items of another district could affect each other's matches and are returned separately.
+    """
+    parent = {}
+
+    def find(key):
+        while parent.setdefault(key, key) != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    def union(*keys):
+        roots = [find(key) for key in keys if key[1] is not None]
+        for root in roots[1:]:
+            parent[root] = roots[0]
+
+    for value in values:
+        union(('uuid', value['uuid']), ('name', value['name']), ('externalid', value['externalID']))
+    with conn.cursor() as cur:
+        for uuid_, name, ext_id in cur.execute("SELECT uuid, name, externalid FROM community;"):
+            union(('uuid', uuid_), ('name', name), ('externalid', ext_id))
+
+    districts = defaultdict(set)
+    for value in values:
+        districts[find(('uuid', value['uuid']))].add(value['district']['uuid'])
+    partitions, conflicting = defaultdict(list), []
+    for value in values:
+        if len(districts[find(('uuid', value['uuid']))]) > 1:
+            conflicting.append(value)
+        else:
+            partitions[value['district']['uuid']].append(value)
+    return partitions, conflicting
+
+
+def align_partitions(table, values: list[dict], progress: dict, checkpoint: dict, conn) -> list[dict]:
+    """
+    Aligns the partitions on WORKERS connections of their own, each partition in one transaction. Their errors end up
+    in the one audit log and errors.log. Returns the conflicting items left for the serial pass.
+    """
+    partitions, conflicting = partition_communities(values, conn)
+    done = progress.setdefault('partitions', [])
+    pending = queue.Queue()
+    for district in sorted(partitions):
+        if district not in done:
+            pending.put(district)
+    logging.info(f"Aligning {pending.qsize()} of {len(partitions)} districts on {WORKERS} connections, "
+                 f"{len(conflicting)} items conflict across districts")
+
+    lock = threading.Lock()
+
+    def work():
+        with connect(CONNECTION, autocommit=True) as worker_conn:
+            while True:
+                try:
+                    district = pending.get_nowait()
+                except queue.Empty:
+                    return
+                with worker_conn.transaction():
+                    align_rows(table, partitions[district], worker_conn)
+                with lock:
+                    done.append(district)
+                    save_checkpoint(checkpoint)
+
+    with ThreadPoolExecutor(WORKERS) as executor:
+        futures = [executor.submit(work) for _ in range(WORKERS)]
+    for future in futures:
+        future.result()
+    return conflicting
+
+
+def align_row(table, central_value: dict[str, str], conn):
+    # STEP 2: check if central item is locally present by uuid
+    if update_by_local_uuid(table, central_value, conn):
+        return
+    if update_by_local_name_and_id(table, central_value, conn):
+        return
+    if table == "country":
+        update_by_local_iso_and_uno_code(table, central_value, conn)
+
+
+def copy_central(table, values: list[dict], conn):
+    with conn.cursor() as cur:
+        cur.execute("CREATE TEMP TABLE central (uuid text PRIMARY KEY, name text, externalid text, isocode text, "
+                    "unocode text) ON COMMIT DROP;")
+        with cur.copy("COPY central (uuid, name, externalid, isocode, unocode) FROM STDIN") as copy:
+            for central_value in values:
+                where_ext_id, where_name = get_where_clause(central_value, table)
+                copy.write_row((central_value['uuid'], where_name, where_ext_id, central_value.get('isoCode'),
+                                central_value.get('unoCode')))
+        cur.execute("ANALYZE central;")
+
+
+def classify_candidates(table, conn):
+    """
+    Fills the temp table candidate with the local rows each central item not present by uuid could be aligned to:
+    by name or external id, for countries without such a match by ISO or UNO code.
+    """
+    name_column = 'defaultname' if has_default_name(table) else 'name'
+    with conn.cursor() as cur:
+        # two equi-joins instead of one OR join, so both can be hash joins
+        cur.execute(f"CREATE TEMP TABLE candidate ON COMMIT DROP AS "
+                    f"SELECT c.uuid AS central_uuid, l.id AS local_id, 'name_or_id' AS kind "
+                    f"FROM central c JOIN {table} l ON l.{name_column} = c.name "
+                    f"WHERE NOT EXISTS (SELECT 1 FROM {table} u WHERE u.uuid = c.uuid) "
+                    f"UNION "
+                    f"SELECT c.uuid, l.id, 'name_or_id' FROM central c JOIN {table} l ON l.externalid = c.externalid "
+                    f"WHERE NOT EXISTS (SELECT 1 FROM {table} u WHERE u.uuid = c.uuid);")
+        if table == "country":
+            cur.execute("INSERT INTO candidate "
+                        "SELECT c.uuid, l.id, 'iso_or_uno' FROM central c JOIN country l "
+                        "ON l.isocode = c.isocode OR l.unocode = c.unocode "
+                        "WHERE NOT EXISTS (SELECT 1 FROM country u WHERE u.uuid = c.uuid) "
+                        "AND NOT EXISTS (SELECT 1 FROM candidate n WHERE n.central_uuid = c.uuid);")
+
+
+def log_updates(table, rows):
+    for row in rows:
+        uuid_changed = f"UUID: {row['old_uuid']} -> {row['uuid']}" if row['old_uuid'] != row['uuid'] else ""
+        name_changed = f"Name: {row['old_name']} -> {row['name']}" if row['old_name'] != row['name'] else ""
+        ext_id_changed = f"Ext. ID: {row['old_externalid']} -> {row['externalid']}" \
+            if row['old_externalid'] != row['externalid'] else ""
+        logging.info(f"\t\tUpdated local item ({','.join([uuid_changed, name_changed, ext_id_changed])})", extra=event('updated', table=table))
+
+
+def align_set(table, values: list[dict], conn) -> list[dict]:
+    """
+    Aligns the central items of table with a few joins against a temp table of them and returns the items the
+    joins cannot decide (duplicates, local rows claimed by several items, unmatched countries) for the row engine.
+    Duplicates of which exactly one local row matches both name and external id are aligned to that row.
+    """
+    name_column = 'defaultname' if has_default_name(table) else 'name'
+    copy_central(table, values, conn)
+    classify_candidates(table, conn)
+    with conn.cursor(row_factory=dict_row) as cur:
+        # present by uuid, but neither name nor external id match
+        insane = cur.execute(f"SELECT c.uuid, c.name, c.externalid, l.{name_column} AS local_name, "
+                               f"l.externalid AS local_externalid FROM central c JOIN {table} l ON l.uuid = c.uuid "
+                               f"WHERE l.{name_column} IS DISTINCT FROM c.name "
+                               f"AND l.externalid IS DISTINCT FROM c.externalid ORDER BY c.uuid;").fetchall()
+        for row in insane:
+            report_error(f"\t\tSanity check failed for {table}: Central: {row['name']}, {row['externalid']} and "
+                         f"Local: {row['local_name']}, {row['local_externalid']}")
+            with SANITY_LOCK:
+                SANITY_FAILURES[table].add(row['uuid'])
+
+        # exactly one candidate, which no other central item claims and which is not aligned by uuid already
+        cur.execute("CREATE TEMP TABLE resolved ON COMMIT DROP AS "
+                    "SELECT central_uuid, min(local_id) AS local_id, min(kind) AS kind FROM candidate "
+                    "GROUP BY central_uuid HAVING count(*) = 1;")
+        cur.execute(f"DELETE FROM resolved r WHERE "
+                    f"EXISTS (SELECT 1 FROM candidate o WHERE o.local_id = r.local_id "
+                    f"AND o.central_uuid <> r.central_uuid) "
+                    f"OR EXISTS (SELECT 1 FROM {table} l JOIN central c ON c.uuid = l.uuid WHERE l.id = r.local_id);")
+        # several candidates, but exactly one matching name and external id, like fix_duplicates of the row engine
+        cur.execute(f"INSERT INTO resolved SELECT n.central_uuid, min(n.local_id), 'name_and_id' FROM candidate n "
+                    f"JOIN central c ON c.uuid = n.central_uuid JOIN {table} l ON l.id = n.local_id "
+                    f"WHERE l.{name_column} = c.name AND l.externalid = c.externalid "
+                    f"AND NOT EXISTS (SELECT 1 FROM resolved r WHERE r.central_uuid = n.central_uuid "
+                    f"OR r.local_id = n.local_id) "
+                    f"AND NOT EXISTS (SELECT 1 FROM central u WHERE u.uuid = l.uuid) "
+                    f"GROUP BY n.central_uuid HAVING count(*) = 1;")
+        cur.execute("DELETE FROM resolved r WHERE kind = 'name_and_id' AND EXISTS (SELECT 1 FROM resolved o "
+                    "WHERE o.local_id = r.local_id AND o.central_uuid <> r.central_uuid);")
+
+        missing = cur.execute("SELECT c.uuid, c.name, c.externalid FROM central c "
+                              f"WHERE NOT EXISTS (SELECT 1 FROM {table} u WHERE u.uuid = c.uuid) "
+                              "AND NOT EXISTS (SELECT 1 FROM candidate n WHERE n.central_uuid = c.uuid) "
+                              "ORDER BY c.uuid;").fetchall()
+        for row in missing:
+            report_error(f"\t\tCould not find local item present in central({row['uuid']}, {row['name']}, "
+                         f"{row['externalid']})")
+
+        by_uuid = cur.execute(f"SELECT count(*) FROM central c JOIN {table} l ON l.uuid = c.uuid;").fetchone()['count']
+        by_name_or_id = cur.execute("SELECT count(*) FROM resolved WHERE kind = 'name_or_id';").fetchone()['count']
+        by_name_and_id = cur.execute("SELECT count(*) FROM resolved WHERE kind = 'name_and_id';").fetchone()['count']
+        by_iso_or_uno = cur.execute("SELECT count(*) FROM resolved WHERE kind = 'iso_or_uno';").fetchone()['count']
+        ambiguous = cur.execute(
+            "SELECT c.uuid FROM central c WHERE EXISTS (SELECT 1 FROM candidate n WHERE n.central_uuid = c.uuid) "
+            "AND NOT EXISTS (SELECT 1 FROM resolved r WHERE r.central_uuid = c.uuid) ORDER BY c.uuid;").fetchall()
+        logging.info(f"{table}: {by_uuid} by uuid, {by_name_or_id} by name or external id, {by_name_and_id} by name "
+                     f"and external id among duplicates, {by_iso_or_uno} by ISO or UNO code, {len(ambiguous)} ambiguous, "
+                     f"{len(missing)} missing")
+
+        if not DRY_RUN:
+            iso_uno = ", isocode = CASE WHEN s.kind = 'iso_or_uno' THEN s.isocode ELSE l.isocode END, " \
+                      "unocode = CASE WHEN s.kind = 'iso_or_uno' THEN s.unocode ELSE l.unocode END" \
+                if table == "country" else ""
+            cur.execute(f"UPDATE {table} l SET archived = FALSE, {name_column} = c.name, externalid = c.externalid "
+                        f"FROM central c WHERE l.uuid = c.uuid AND (l.{name_column} IS NOT DISTINCT FROM c.name "
+                        f"OR l.externalid IS NOT DISTINCT FROM c.externalid) "
+                        f"AND (l.{name_column}, l.externalid, l.archived) IS DISTINCT FROM (c.name, c.externalid, FALSE);")
+            count_unchanged(table, by_uuid - len(insane) - cur.rowcount)
+            log_updates(table, cur.execute(
+                f"UPDATE {table} l SET uuid = s.uuid, archived = FALSE, {name_column} = s.name, "
+                f"externalid = s.externalid{iso_uno} "
+                f"FROM (SELECT r.local_id, r.kind, c.*, o.uuid AS old_uuid, o.{name_column} AS old_name, "
+                f"o.externalid AS old_externalid FROM resolved r JOIN central c ON c.uuid = r.central_uuid "
+                f"JOIN {table} o ON o.id = r.local_id) s WHERE l.id = s.local_id "
+                f"RETURNING s.uuid, s.name, s.externalid, s.old_uuid, s.old_name, s.old_externalid;").fetchall())
+        cur.execute("DROP TABLE central, candidate, resolved;")
+
+    ambiguous_uuids = {row['uuid'] for row in ambiguous}
+    return [central_value for central_value in values if central_value['uuid'] in ambiguous_uuids]
+
+
+class LocalSnapshot:
+    """
+    In-memory copy of a local infrastructure table, indexed by the columns the row engine queries.
+    Updates change the copy in place and are recorded in order, to be written back with executemany.
+    """
+
+    def __init__(self, table, rows: list[dict]):
+        self.table = table
+        self.columns = ['uuid', 'defaultname' if has_default_name(table) else 'name', 'externalid']
+        if table == "country":
+            self.columns += ['isocode', 'unocode']
+        self.rows = rows
+        self.indexes: dict[str, dict[str, list[dict]]] = {column: defaultdict(list) for column in self.columns}
+        self.updates: list[dict] = []
+        for row in rows:
+            self._index(row)
+
+    def _index(self, row):
+        for column in self.columns:
+            self.indexes[column][row[column]].append(row)
+
+    def _unindex(self, row):
+        for column in self.columns:
+            self.indexes[column][row[column]].remove(row)
+
+    def find(self, column, value) -> list[dict]:
+        return list(self.indexes[column].get(value, ()))
+
+    def find_any(self, **values) -> list[dict]:
+        """
+        Rows matching any of the column values, in id order like the table scan of the row engine.
+        """
+        found = {row['id']: row for column, value in values.items() for row in self.indexes[column].get(value, ())}
+        return [found[id_] for id_ in sorted(found)]
+
+    def update(self, row, values: dict):
+        old = {column: row[column] for column in self.columns}
+        self._unindex(row)
+        row.update(values, archived=False)
+        self._index(row)
+        self.updates.append({'id': row['id'], 'old': old, 'new': {column: row[column] for column in self.columns}})
+
+
+def read_snapshot(table, conn) -> LocalSnapshot:
+    columns = ', '.join(['id', 'uuid', 'defaultname' if has_default_name(table) else 'name', 'externalid', 'archived']
+                        + (['isocode', 'unocode'] if table == "country" else []))
+    # server-side cursor, the table is streamed instead of fetched in one piece
+    with conn.cursor(name=f"snapshot_{table}", row_factory=dict_row) as cur:
+        cur.itersize = BATCH_SIZE
+        cur.execute(f"SELECT {columns} FROM {table} ORDER BY id;")
+        return LocalSnapshot(table, list(cur))
+
+
+def write_updates(table, columns: list[str], updates: list[dict], conn):
+    """
+    Writes recorded updates with executemany in batches. An update only applies while the row still holds the values
+    it was matched with, a row changed in the meantime fails the whole table.
+    """
+    if DRY_RUN or not updates:
+        return
+    assignments = ', '.join(f"{column}=%s" for column in columns)
+    guard = ' AND '.join(f"{column} IS NOT DISTINCT FROM %s" for column in columns)
+    with conn.cursor() as cur:
+        for start in range(0, len(updates), BATCH_SIZE):
+            batch = updates[start:start + BATCH_SIZE]
+            cur.executemany(f"UPDATE {table} SET archived=FALSE, {assignments} WHERE id=%s AND {guard};",
+                            [[update['new'][column] for column in columns] + [update['id']]
+                             + [update['old'][column] for column in columns] for update in batch])
+            if cur.rowcount != len(batch):
+                raise Exception(f"{len(batch) - cur.rowcount} rows of {table} changed since they were matched. "
+                                f"Nothing of {table} was written, please plan again.")
+    logging.info(f"Wrote {len(updates)} updates of {table}")
+
+
+def describe_update(local: dict, central_uuid, name, ext_id) -> str:
+    local_name = get_local_name(local)
+    uuid_changed = f"UUID: {local['uuid']} -> {central_uuid}" if local['uuid'] != central_uuid else ""
+    name_changed = f"Name: {local_name} -> {name}" if local_name != name else ""
+    ext_id_changed = f"Ext. ID: {local['externalid']} -> {ext_id}" if local['externalid'] != ext_id else ""
+    return ','.join([uuid_changed, name_changed, ext_id_changed])
+
+
+def update_snapshot(table, snapshot: LocalSnapshot, row: dict, values: dict):
+    # an item holding the central values already is not written again
+    if not row['archived'] and all(row[column] == value for column, value in values.items()):
+        report_unchanged(table, values['uuid'])
+        return
+    logging.info(f"\t\tUpdated local item "
+                 f"({describe_update(row, values['uuid'], values[snapshot.columns[1]], values['externalid'])})",
+                 extra=event('updated', table=table))
+    snapshot.update(row, values)
+
+
+def align_snapshot(table, values: list[dict], conn):
+    snapshot = match_snapshot(table, values, conn)
+    write_updates(table, snapshot.columns, snapshot.updates, conn)
+
+
+def plan_table(table, values: list[dict], archive: str | list[str], conn) -> dict:
+    errors, manual_cleanup = len(error_list), len(manual_cleanup_list)
+    snapshot = match_snapshot(table, values, conn, archive_all=archive == 'all')
+    logging.info(f"Planned {len(snapshot.updates)} updates of {table}, {UNCHANGED[table]} items hold the central "
+                 f"values already")
+    if archive == 'unmatched':
+        # the items left without central counterpart or failing the sanity check keep their uuid, so they can be
+        # listed for apply
+        uuids = {value['uuid'] for value in values}
+        archive = [row['uuid'] for row in snapshot.rows if not row['archived']
+                   and (row['uuid'] not in uuids or row['uuid'] in SANITY_FAILURES[table])]
+        logging.info(f"Planned archiving {len(archive)} items of {table} without central counterpart")
+    return {
+        'archive': archive,
+        'columns': snapshot.columns,
+        'updates': snapshot.updates,
+        'conflicts': [error.strip() for error in error_list[errors:]],
+        'manual_cleanup': manual_cleanup_list[manual_cleanup:],
+    }
+
+
+def apply_plan(plan: dict, conn):
+    for table, table_plan in plan['tables'].items():
+        logging.info(f"Apply plan of {table}: {len(table_plan['updates'])} updates, "
+                     f"{len(table_plan['manual_cleanup'])} left for manual cleanup")
+        with phase('apply', table, items=len(table_plan['updates'])), conn.transaction():
+            archive_table(table, table_plan['archive'], conn)
+            write_updates(table, table_plan['columns'], table_plan['updates'], conn)
+
+
+def match_snapshot(table, values: list[dict], conn, archive_all=False) -> LocalSnapshot:
+    """
+    Applies the rules of the row engine to a snapshot of the local table, in the same order, so later items see the
+    effect of earlier ones exactly like in the database. With archive_all the snapshot is treated as archived, like
+    the table will be when a plan is applied, so every match is recorded as an update.
+    """
+    snapshot = read_snapshot(table, conn)
+    if archive_all:
+        for row in snapshot.rows:
+            row['archived'] = True
+    name_column = snapshot.columns[1]
+    length = len(values)
+
+    for index, central_value in enumerate(values):
+        where_ext_id, where_name = get_where_clause(central_value, table)
+        central_uuid: str = central_value['uuid']
+        logging.info(f"{index + 1}/{length}: Processing {where_name}, {where_ext_id}, {central_uuid}",
+                     extra=event('processing', table=table, index=index + 1, total=length, uuid=central_uuid))
+
+        new_values = {'uuid': central_uuid, name_column: where_name, 'externalid': where_ext_id}
+
+        # by uuid
+        local = snapshot.find('uuid', central_uuid)
+        if local:
+            if sanity_check(central_value, local[0], table) and not DRY_RUN:
+                update_snapshot(table, snapshot, local[0], new_values)
+            continue
+
+        # by name or external id
+        local = snapshot.find_any(**{name_column: where_name, 'externalid': where_ext_id})
+        if len(local) == 1:
+            if not DRY_RUN:
+                update_snapshot(table, snapshot, local[0], new_values)
                 continue
-            if update_by_local_name_and_id(table, central_value):
+        elif len(local) > 1:
+            if snapshot_fix_duplicates(central_value, table, local, new_values, snapshot):
                 continue
-            if table == "country":
-                update_by_local_iso_and_uno_code(table, central_value)
-
+        else:
+            report_error(f"\t\tCould not find local item present in central({central_uuid}, {where_name}, {where_ext_id})")
 
-def update_by_local_iso_and_uno_code(table, central_value: dict[str, str]):
-    with psycopg.connect(CONNECTION) as conn:
-        with conn.cursor(row_factory=dict_row) as cur:
-            where_ext_id, where_name = get_where_clause(central_value, table)
+        if table == "country":
             iso_code, uno_code = central_value['isoCode'], central_value['unoCode']
-            local: dict[str, str] = cur.execute(
-                f"SELECT * FROM {table} WHERE defaultname=%s OR externalid=%s OR isocode=%s OR unocode=%s;",
-                (where_name, where_ext_id, iso_code, uno_code)).fetchone()
-            if local is None:
+            local = snapshot.find_any(defaultname=where_name, externalid=where_ext_id, isocode=iso_code,
+                                      unocode=uno_code)
+            if not local:
                 logging.info(f"Could not find {central_value} locally")
-                return
+            elif len(local) > 1:
+                report_error(
+                    f"\t\tCould not update UUID of {local[0]['uuid']}: {where_name}, {where_ext_id}, "
+                    f"{local[0]['isocode']},{local[0]['unocode']} "
+                    f"Either the name or external ID are present multiple times in the local DB.")
+            elif not DRY_RUN:
+                update_snapshot(table, snapshot, local[0], dict(new_values, isocode=iso_code, unocode=uno_code))
 
-            local_uuid: str = local['uuid']
-            local_name: str = get_local_name(local)
-            local_ext_id: str = local['externalid']
-            central_uuid: str = central_value['uuid']
-            iso_code, uno_code = central_value['isoCode'], central_value['unoCode']
-            try:
-                if DRY_RUN:
-                    if cur.execute(
-                            f"SELECT COUNT(*) FROM {table} WHERE uuid=%s OR (defaultname=%s OR externalid=%s OR isocode=%s OR unocode=%s);",
-                            (central_uuid, where_name, where_ext_id, iso_code, uno_code)).fetchone()['count'] > 1:
-                        raise UniqueViolation()
-                else:
+    if table == "community":
+        # the snapshot already holds the result of the alignment
+        warn_about_missing_communities(Counter(row['name'] for row in snapshot.rows))
+    return snapshot
+
+
+def snapshot_fix_duplicates(central_value, table, local: list[dict], new_values: dict, snapshot: LocalSnapshot):
+    where_ext_id, where_name = get_where_clause(central_value, table)
+    name_column = snapshot.columns[1]
+    true_duplicates = [row for row in local if row[name_column] == where_name and row['externalid'] == where_ext_id]
+    logging.info(f"\tfound {len(local)} duplicates of {where_name} or {where_ext_id} in {table}")
+    logging.info(f"\tfound true {true_duplicates} duplicates of {where_name} and {where_ext_id} in {table}")
+
+    if len(true_duplicates) == 1:
+        if not DRY_RUN:
+            update_snapshot(table, snapshot, true_duplicates[0], new_values)
+        return True
+
+    if not BAVARIAN_MODE:
+        report_manual_cleanup(central_value, table)
+        return False
+
+    # bavarian mode: the referenced duplicate survives
+    assert table == "community"
+    match_id = choose_survivor(central_value, table, {row['id']: row['uuid'] for row in local})
+    if match_id is None:
+        return False
+    match = next(row for row in local if row['id'] == match_id)
+    if DRY_RUN:
+        report_error(f"\t\tUpdating {match['id']} in bavarian mode")
+        return False
+    update_snapshot(table, snapshot, match, new_values)
+    return False
+
+
+def update_by_local_iso_and_uno_code(table, central_value: dict[str, str], conn):
+    with conn.cursor(row_factory=dict_row) as cur:
+        where_ext_id, where_name = get_where_clause(central_value, table)
+        iso_code, uno_code = central_value['isoCode'], central_value['unoCode']
+        local: dict[str, str] = cur.execute(
+            f"SELECT * FROM {table} WHERE defaultname=%s OR externalid=%s OR isocode=%s OR unocode=%s;",
+            (where_name, where_ext_id, iso_code, uno_code)).fetchone()
+        if local is None:
+            logging.info(f"Could not find {central_value} locally")
+            return
+
+        local_uuid: str = local['uuid']
+        local_name: str = get_local_name(local)
+        local_ext_id: str = local['externalid']
+        central_uuid: str = central_value['uuid']
+        iso_code, uno_code = central_value['isoCode'], central_value['unoCode']
+        try:
+            if DRY_RUN:
+                if cur.execute(
+                        f"SELECT COUNT(*) FROM {table} WHERE uuid=%s OR (defaultname=%s OR externalid=%s OR isocode=%s OR unocode=%s);",
+                        (central_uuid, where_name, where_ext_id, iso_code, uno_code)).fetchone()['count'] > 1:
+                    raise UniqueViolation()
+            else:
+                # savepoint, a unique violation must not abort the transaction of the whole table
+                with conn.transaction():
                     cur.execute(
-                        f"UPDATE {table} SET uuid=%s,archived=FALSE,defaultname=%s,externalid=%s, isocode=%s, unocode=%s WHERE uuid=%s OR (defaultname=%s OR externalid=%s OR isocode=%s OR unocode=%s);",
+                        f"UPDATE {table} SET uuid=%s,archived=FALSE,defaultname=%s,externalid=%s, isocode=%s, unocode=%s WHERE (uuid=%s OR (defaultname=%s OR externalid=%s OR isocode=%s OR unocode=%s)) "
+                        f"AND {differs('uuid', 'defaultname', 'externalid', 'isocode', 'unocode')};",
                         (central_uuid, where_name, where_ext_id, iso_code, uno_code, central_uuid, where_name,
                          where_ext_id,
-                         iso_code, uno_code))
-                if not DRY_RUN:
-                    uuid_changed: str = f"UUID: {local_uuid} -> {central_uuid}" if local_uuid != central_uuid else ""
-                    name_changed: str = f"Name: {local_name} -> {where_name}" if local_name != where_name else ""
-                    ext_id_changed: str = f"Ext. ID: {local_ext_id} -> {where_ext_id}" if local_ext_id != where_ext_id else ""
-                    iso_code_changed: str = f"ISO: {local['isocode']} -> {iso_code}" if local[
-                                                                                            'isocode'] != iso_code else ""
-                    uno_code_changed: str = f"UNO: {local['unocode']} -> {uno_code}" if local[
-                                                                                            'unocode'] != uno_code else ""
-                    logging.info(
-                        f"\t\tUpdated local item ({','.join([uuid_changed, name_changed, ext_id_changed, iso_code_changed, uno_code_changed])})")
-                    return True
-            except UniqueViolation:
-                report_error(
-                    f"\t\tCould not update UUID of {local_uuid}: {where_name}, {where_ext_id}, {local['isocode']},{local['unocode']} "
-                    f"Either the name or external ID are present multiple times in the local DB.")
-                return False
-
-
-def update_by_local_uuid(table, central_value: dict[str, str]):
-    with psycopg.connect(CONNECTION) as conn:
-        with conn.cursor(row_factory=dict_row) as cur:
-            local: dict[str, str] = cur.execute(f"SELECT * FROM {table} WHERE uuid=%s",
-                                                [central_value['uuid']]).fetchone()
-            if local:
-                perform_update_uuid(central_value, local, table, conn)
-                if not DRY_RUN:
-                    logging.info(f"\t\tExact local uuid match de-archived and name/external id aligned!")
+                         iso_code, uno_code, central_uuid, where_name, where_ext_id, iso_code, uno_code))
+            if not DRY_RUN and cur.rowcount == 0:
+                report_unchanged(table, central_uuid)
                 return True
-            else:
-                if not DRY_RUN:
-                    logging.info(f"\t\tNo exact local uuid match! Continue with name and external id lookup!")
-                return False
+            if not DRY_RUN:
+                uuid_changed: str = f"UUID: {local_uuid} -> {central_uuid}" if local_uuid != central_uuid else ""
+                name_changed: str = f"Name: {local_name} -> {where_name}" if local_name != where_name else ""
+                ext_id_changed: str = f"Ext. ID: {local_ext_id} -> {where_ext_id}" if local_ext_id != where_ext_id else ""
+                iso_code_changed: str = f"ISO: {local['isocode']} -> {iso_code}" if local[
+                                                                                        'isocode'] != iso_code else ""
+                uno_code_changed: str = f"UNO: {local['unocode']} -> {uno_code}" if local[
+                                                                                        'unocode'] != uno_code else ""
+                logging.info(
+                    f"\t\tUpdated local item ({','.join([uuid_changed, name_changed, ext_id_changed, iso_code_changed, uno_code_changed])})", extra=event('updated', table=table))
+                return True
+        except UniqueViolation:
+            report_error(
+                f"\t\tCould not update UUID of {local_uuid}: {where_name}, {where_ext_id}, {local['isocode']},{local['unocode']} "
+                f"Either the name or external ID are present multiple times in the local DB.")
+            return False
+
+
+def update_by_local_uuid(table, central_value: dict[str, str], conn):
+    with conn.cursor(row_factory=dict_row) as cur:
+        local: dict[str, str] = cur.execute(f"SELECT * FROM {table} WHERE uuid=%s",
+                                            [central_value['uuid']]).fetchone()
+        if local:
+            perform_update_uuid(central_value, local, table, conn)
+            if not DRY_RUN:
+                logging.info(f"\t\tExact local uuid match de-archived and name/external id aligned!")
+            return True
+        else:
+            if not DRY_RUN:
+                logging.info(f"\t\tNo exact local uuid match! Continue with name and external id lookup!")
+            return False
 
 
-def update_by_local_name_and_id(table, central_value: dict[str, str]):
-    with psycopg.connect(CONNECTION) as conn:
-        with conn.cursor(row_factory=dict_row) as cur:
-            where_ext_id, where_name = get_where_clause(central_value, table)
+def update_by_local_name_and_id(table, central_value: dict[str, str], conn):
+    with conn.cursor(row_factory=dict_row) as cur:
+        where_ext_id, where_name = get_where_clause(central_value, table)
 
-            if has_default_name(table):
-                local = cur.execute(f"SELECT * FROM {table} WHERE defaultname=%s OR externalid=%s;",
-                                    (where_name, where_ext_id)).fetchall()
-            else:
-                local = cur.execute(f"SELECT * FROM {table} WHERE name=%s OR externalid=%s;",
-                                    (where_name, where_ext_id)).fetchall()
+        if has_default_name(table):
+            local = cur.execute(f"SELECT * FROM {table} WHERE defaultname=%s OR externalid=%s;",
+                                (where_name, where_ext_id)).fetchall()
+        else:
+            local = cur.execute(f"SELECT * FROM {table} WHERE name=%s OR externalid=%s;",
+                                (where_name, where_ext_id)).fetchall()
 
-            if len(local) == 1:
-                return perform_update_name_or_id(central_value, local[0], table, conn)
-            elif len(local) > 1:
-                return fix_duplicates(central_value, table, conn)
-            else:
-                report_error(
-                    f"\t\tCould not find local item present in central({central_value['uuid']}, {where_name}, {where_ext_id})")
-                return False
+        if len(local) == 1:
+            return perform_update_name_or_id(central_value, local[0], table, conn)
+        elif len(local) > 1:
+            return fix_duplicates(central_value, table, conn)
+        else:
+            report_error(
+                f"\t\tCould not find local item present in central({central_value['uuid']}, {where_name}, {where_ext_id})")
+            return False
 
 
 def perform_update_uuid(central_value: dict[str, str], local: dict[str, str], table: str, conn):
@@ -255,9 +977,11 @@ def perform_update_uuid(central_value: dict[str, str], local: dict[str, str], ta
                         report_error(
                             f"Duplicate in {table} WHERE uuid={central_uuid}")
                 else:
-                    cur.execute(
-                        f"UPDATE {table} SET uuid=%s,archived=FALSE,defaultname=%s,externalid=%s WHERE uuid=%s;",
-                        (central_uuid, where_name, where_ext_id, central_uuid))
+                    with conn.transaction():
+                        cur.execute(
+                            f"UPDATE {table} SET uuid=%s,archived=FALSE,defaultname=%s,externalid=%s "
+                            f"WHERE uuid=%s AND {differs('defaultname', 'externalid')};",
+                            (central_uuid, where_name, where_ext_id, central_uuid, where_name, where_ext_id))
             else:
 
                 if DRY_RUN:
@@ -266,16 +990,20 @@ def perform_update_uuid(central_value: dict[str, str], local: dict[str, str], ta
                         report_error(
                             f"Duplicate in {table} WHERE uuid={central_uuid}")
                 else:
-                    cur.execute(
-                        f"UPDATE {table} SET uuid=%s,archived=FALSE,name=%s,externalid=%s WHERE uuid=%s;",
-                        (central_uuid, where_name, where_ext_id, central_uuid))
-            if not DRY_RUN:
+                    with conn.transaction():
+                        cur.execute(
+                            f"UPDATE {table} SET uuid=%s,archived=FALSE,name=%s,externalid=%s "
+                            f"WHERE uuid=%s AND {differs('name', 'externalid')};",
+                            (central_uuid, where_name, where_ext_id, central_uuid, where_name, where_ext_id))
+            if not DRY_RUN and cur.rowcount == 0:
+                report_unchanged(table, central_uuid)
+            elif not DRY_RUN:
                 uuid_changed = f"UUID: {local_uuid} -> {central_uuid}" if local_uuid != central_uuid else ""
                 name_changed = f"Name: {local_name} -> {where_name}" if local_name != where_name else ""
                 ext_id_changed = f"Ext. ID: {local_ext_id} -> {where_ext_id}" if local_ext_id != where_ext_id else ""
 
                 logging.info(
-                    f"\t\tUpdated local item ({','.join([uuid_changed, name_changed, ext_id_changed])})")
+                    f"\t\tUpdated local item ({','.join([uuid_changed, name_changed, ext_id_changed])})", extra=event('updated', table=table))
             return True
         except UniqueViolation as e:
             # we have duplicates for name OR external id
@@ -303,9 +1031,12 @@ def perform_update_name_or_id(central_value, local, table, conn):
                             f"\t\tDuplicate in {table} WHERE defaultname={where_name} OR externalid={where_ext_id}")
                         raise UniqueViolation
                 else:
-                    cur.execute(
-                        f"UPDATE {table} SET uuid=%s,archived=FALSE,defaultname=%s,externalid=%s WHERE defaultname=%s OR externalid=%s;",
-                        (central_uuid, where_name, where_ext_id, where_name, where_ext_id))
+                    with conn.transaction():
+                        cur.execute(
+                            f"UPDATE {table} SET uuid=%s,archived=FALSE,defaultname=%s,externalid=%s "
+                            f"WHERE (defaultname=%s OR externalid=%s) AND {differs('uuid', 'defaultname', 'externalid')};",
+                            (central_uuid, where_name, where_ext_id, where_name, where_ext_id,
+                             central_uuid, where_name, where_ext_id))
             else:
                 if DRY_RUN:
                     if cur.execute(
@@ -315,16 +1046,22 @@ def perform_update_name_or_id(central_value, local, table, conn):
                             f"\t\tDuplicate in {table} WHERE name={where_name} OR externalid={where_ext_id}")
                         raise UniqueViolation
                 else:
-                    cur.execute(
-                        f"UPDATE {table} SET uuid=%s,archived=FALSE,name=%s,externalid=%s WHERE name=%s OR externalid=%s;",
-                        (central_uuid, where_name, where_ext_id, where_name, where_ext_id))
+                    with conn.transaction():
+                        cur.execute(
+                            f"UPDATE {table} SET uuid=%s,archived=FALSE,name=%s,externalid=%s "
+                            f"WHERE (name=%s OR externalid=%s) AND {differs('uuid', 'name', 'externalid')};",
+                            (central_uuid, where_name, where_ext_id, where_name, where_ext_id,
+                             central_uuid, where_name, where_ext_id))
+            if not DRY_RUN and cur.rowcount == 0:
+                report_unchanged(table, central_uuid)
+                return True
             if not DRY_RUN:
                 uuid_changed = f"UUID: {local_uuid} -> {central_uuid}" if local_uuid != central_uuid else ""
                 name_changed = f"Name: {local_name} -> {where_name}" if local_name != where_name else ""
                 ext_id_changed = f"Ext. ID: {local_ext_id} -> {where_ext_id}" if local_ext_id != where_ext_id else ""
 
                 logging.info(
-                    f"\t\tUpdated local item ({','.join([uuid_changed, name_changed, ext_id_changed])})")
+                    f"\t\tUpdated local item ({','.join([uuid_changed, name_changed, ext_id_changed])})", extra=event('updated', table=table))
                 return True
         except UniqueViolation:
             # we have duplicates for name OR external id
@@ -366,8 +1103,9 @@ def fix_duplicates(central_value, table, conn):
                             f"\t\tDuplicate in {table} WHERE defaultname={where_name} AND externalid={where_ext_id}")
                 else:
                     cur.execute(
-                        f"UPDATE {table} SET uuid=%s,archived=FALSE,defaultname=%s,externalid=%s WHERE defaultname=%s AND externalid=%s;",
-                        (central_uuid, where_name, where_ext_id, where_name, where_ext_id))
+                        f"UPDATE {table} SET uuid=%s,archived=FALSE,defaultname=%s,externalid=%s "
+                        f"WHERE defaultname=%s AND externalid=%s AND {differs('uuid')};",
+                        (central_uuid, where_name, where_ext_id, where_name, where_ext_id, central_uuid))
 
             else:
                 if cur.execute(
@@ -377,9 +1115,12 @@ def fix_duplicates(central_value, table, conn):
                         f"\t\tDuplicate in {table} WHERE name={where_name} AND externalid={where_ext_id}")
                 else:
                     cur.execute(
-                        f"UPDATE {table} SET uuid=%s,archived=FALSE,name=%s,externalid=%s WHERE name=%s AND externalid=%s;",
-                        (central_uuid, where_name, where_ext_id, where_name, where_ext_id))
-            if not DRY_RUN:
+                        f"UPDATE {table} SET uuid=%s,archived=FALSE,name=%s,externalid=%s "
+                        f"WHERE name=%s AND externalid=%s AND {differs('uuid')};",
+                        (central_uuid, where_name, where_ext_id, where_name, where_ext_id, central_uuid))
+            if not DRY_RUN and cur.rowcount == 0:
+                report_unchanged(table, central_uuid)
+            elif not DRY_RUN:
                 local_uuid: str = true_duplicates[0]['uuid']
                 local_ext_id: str = true_duplicates[0]['externalid']
                 local_name: str = true_duplicates[0]['defaultname'] if has_default_name(table) else true_duplicates[0][
@@ -390,71 +1131,151 @@ def fix_duplicates(central_value, table, conn):
                 ext_id_changed = f"Ext. ID: {local_ext_id} -> {where_ext_id}" if local_ext_id != where_ext_id else ""
 
                 logging.info(
-                    f"\t\tUpdated local item ({','.join([uuid_changed, name_changed, ext_id_changed])})")
+                    f"\t\tUpdated local item ({','.join([uuid_changed, name_changed, ext_id_changed])})", extra=event('updated', table=table))
             return True
         else:
             return try_resolve_duplicates(central_value, table, conn)
 
 
 def bavarian_mode(central_value, table, conn):
-    with conn.cursor(row_factory=dict_row) as cur:
-        assert table == "community"
-        can_join = {}
-        central_uuid = central_value['uuid']
-        central_name = central_value['name']
-        central_ext_id = central_value['externalID']
-
-        with conn.cursor(row_factory=dict_row) as cur:
-            res = cur.execute(f"SELECT id FROM {table} WHERE name=%s OR externalid=%s;",
-                              (central_name, central_ext_id)).fetchall()
-
-            for duplicate in res:
-                # join the community table with the facility table on the id of the duplicate
-                join = cur.execute(
-                    f"SELECT community.id from community JOIN facility f on community.id = f.community_id "
-                    f"WHERE f.community_id = %s;", (duplicate['id'],)).fetchone()
-
-                can_join[duplicate['id']] = True if join else False
-
-            # count the number of True values in the can_join dict
-            num_can_join = sum(can_join.values())
-
-            if num_can_join == 0:
-                report_manual_cleanup(central_value, table)
-
-            if num_can_join > 1:
-                report_manual_cleanup(central_value, table)
-
-            match = None
-            # get the element from the can_join dict where the value is True
-            for key, value in can_join.items():
-                if value:
-                    match = key
-                    break
-            assert match
-
-            local = cur.execute("SELECT * FROM community WHERE id=%s;", (match,)).fetchone()
-
-            if DRY_RUN:
-                report_error(f"\t\tUpdating {match} in bavarian mode")
-                return True
-
-            cur.execute(
-                f"UPDATE {table} SET uuid=%s,archived=FALSE,name=%s,externalid=%s WHERE id=%s;",
-                (central_uuid, central_name, central_ext_id, match))
-
-            local_uuid = local['uuid']
-            local_ext_id = local['externalid']
-            local_name = local['name']
+    assert table == "community"
+    central_uuid = central_value['uuid']
+    central_name = central_value['name']
+    central_ext_id = central_value['externalID']
+
+    with conn.cursor() as cur:
+        duplicates = dict(cur.execute(f"SELECT id, uuid FROM {table} WHERE name=%s OR externalid=%s ORDER BY id;",
+                                      (central_name, central_ext_id)).fetchall())
+    match = choose_survivor(central_value, table, duplicates)
+    if match is None:
+        return False
 
-            uuid_changed = f"UUID: {local_uuid} -> {central_uuid}" if local_uuid != central_uuid else ""
-            name_changed = f"Name: {local_name} -> {central_name}" if local_name != central_name else ""
-            ext_id_changed = f"Ext. ID: {local_ext_id} -> {central_ext_id}" if local_ext_id != central_ext_id else ""
+    if DRY_RUN:
+        report_error(f"\t\tUpdating {match} in bavarian mode")
+        return True
 
-            logging.info(
-                f"\t\tUpdated local item ({','.join([uuid_changed, name_changed, ext_id_changed])})")
+    with conn.cursor(row_factory=dict_row) as cur:
+        # the self join returns the values before the update
+        local = cur.execute(
+            f"UPDATE {table} l SET uuid=%s,archived=FALSE,name=%s,externalid=%s FROM {table} o "
+            f"WHERE l.id=%s AND o.id=l.id RETURNING o.uuid, o.name, o.externalid;",
+            (central_uuid, central_name, central_ext_id, match)).fetchone()
 
-            return True
+        local_uuid = local['uuid']
+        local_ext_id = local['externalid']
+        local_name = local['name']
+
+        uuid_changed = f"UUID: {local_uuid} -> {central_uuid}" if local_uuid != central_uuid else ""
+        name_changed = f"Name: {local_name} -> {central_name}" if local_name != central_name else ""
+        ext_id_changed = f"Ext. ID: {local_ext_id} -> {central_ext_id}" if local_ext_id != central_ext_id else ""
+
+        logging.info(
+            f"\t\tUpdated local item ({','.join([uuid_changed, name_changed, ext_id_changed])})", extra=event('updated', table=table))
+
+        return True
+
+
+def read_community_references(conn) -> dict[int, dict[str, int]]:
+    """
+    Counts the references to every community from each of the REFERENCING_TABLES present, in one query.
+    """
+    with conn.cursor() as cur:
+        present = {row[0] for row in cur.execute(
+            "SELECT table_name FROM information_schema.columns WHERE table_schema = current_schema() "
+            "AND column_name = 'community_id' AND table_name = ANY(%s);", (REFERENCING_TABLES,)).fetchall()}
+        tables = [table for table in REFERENCING_TABLES if table in present]
+        references = defaultdict(dict)
+        if not tables:
+            return references
+        query = ' UNION ALL '.join(f"SELECT community_id, '{table}', count(*) FROM {table} "
+                                   f"WHERE community_id IS NOT NULL GROUP BY community_id" for table in tables)
+        for community_id, table, count in cur.execute(query + ';'):
+            references[community_id][table] = count
+    return references
+
+
+def pick_survivor(ids: list[int]) -> tuple[int | None, str | None]:
+    """
+    Returns the duplicate to keep and the table deciding it: facilities first, then cases, contacts and users.
+    The first table referencing exactly one of the duplicates decides, one referencing several leaves it undecided.
+    """
+    for table in REFERENCING_TABLES:
+        referenced = [id_ for id_ in ids if COMMUNITY_REFERENCES.get(id_, {}).get(table)]
+        if len(referenced) == 1:
+            return referenced[0], table
+        if referenced:
+            break
+    return None, None
+
+
+def describe_references(id_: int) -> str:
+    references = COMMUNITY_REFERENCES.get(id_, {})
+    return f"{id_} ({', '.join(f'{table}: {count}' for table, count in references.items()) or 'unreferenced'})"
+
+
+def choose_survivor(central_value, table, duplicates: dict[int, str]) -> int | None:
+    """
+    Returns the duplicate to align central_value to among its current local duplicates, given as uuid by id.
+    The survivor chosen up front by resolve_bavarian_groups is kept while it is still one of them and not claimed by
+    another central item, otherwise it is chosen again among the duplicates that are not claimed.
+    """
+    central_uuid = central_value['uuid']
+    available = [id_ for id_, uuid_ in duplicates.items() if uuid_ == central_uuid or uuid_ not in CENTRAL_UUIDS]
+    match = BAVARIAN_GROUPS.get(central_uuid, {}).get('survivor')
+    if match in available:
+        return match
+    # the local table changed since the groups were gathered, or the item was present by uuid then
+    match, _ = pick_survivor(available)
+    if match is not None:
+        return match
+    report_manual_cleanup(central_value, table)
+    # archiving on conflict: keep the most referenced duplicate, if any is referenced at all
+    referenced = [id_ for id_ in available if COMMUNITY_REFERENCES.get(id_)]
+    if not referenced:
+        report_error(f"\t\tNone of the duplicates {available} of {central_uuid} is referenced, left archived")
+        return None
+    return max(referenced, key=lambda id_: (sum(COMMUNITY_REFERENCES[id_].values()), -id_))
+
+
+def resolve_bavarian_groups(values: list[dict], central_uuids, conn):
+    """
+    Gathers the local duplicates of all central communities missing by uuid and reports for every group the survivor bavarian mode
+    will keep and the references deciding it. The groups and the reference counts are kept for the alignment itself.
+    Duplicates carrying the uuid of another of the central_uuids are not available as survivor.
+    """
+    COMMUNITY_REFERENCES.clear()
+    COMMUNITY_REFERENCES.update(read_community_references(conn))
+    BAVARIAN_GROUPS.clear()
+    CENTRAL_UUIDS.clear()
+    CENTRAL_UUIDS.update(central_uuids)
+    uuids, by_name, by_ext_id = dict(), defaultdict(set), defaultdict(set)
+    with conn.cursor() as cur:
+        for id_, uuid_, name, ext_id in cur.execute("SELECT id, uuid, name, externalid FROM community;"):
+            uuids[uuid_] = id_
+            by_name[name].add(id_)
+            by_ext_id[ext_id].add(id_)
+
+    claimed = {id_ for uuid_, id_ in uuids.items() if uuid_ in CENTRAL_UUIDS}
+    groups, decided = 0, 0
+    for value in values:
+        if value['uuid'] in uuids:
+            # aligned by uuid, its duplicates are not resolved
+            continue
+        names, ext_ids = by_name.get(value['name'], set()), by_ext_id.get(value['externalID'], set())
+        ids = sorted(names | ext_ids)
+        if len(ids) < 2 or len(names & ext_ids) == 1:
+            continue
+        groups += 1
+        match, deciding_table = pick_survivor([id_ for id_ in ids if id_ not in claimed])
+        BAVARIAN_GROUPS[value['uuid']] = {'survivor': match, 'table': deciding_table}
+        duplicates = ', '.join(describe_references(id_) for id_ in ids)
+        if match is None:
+            logging.info(f"\t{value['name']}, {value['externalID']}: undecided between {duplicates}")
+        else:
+            decided += 1
+            logging.info(f"\t{value['name']}, {value['externalID']}: {match} survives by its {deciding_table} "
+                         f"references, duplicates {duplicates}")
+    logging.info(f"Bavarian mode decides {decided} of {groups} groups of duplicate communities")
 
 
 def report_manual_cleanup(central_value, table):
@@ -462,8 +1283,10 @@ def report_manual_cleanup(central_value, table):
           f"CLEANUP MANUALLY AND THEN RESTART THE SCRIPT. " \
           f"Run SELECT * FROM {table} WHERE name='{central_value['name']}' " \
           f"OR externalid='{central_value['externalID']}' to see the duplicates."
+    manual_cleanup_list.append({'uuid': central_value['uuid'], 'name': central_value['name'],
+                                'externalID': central_value['externalID']})
 
-    if DRY_RUN:
+    if DRY_RUN or COMMAND == 'plan':
         report_error(msg)
         return False
 
@@ -511,6 +1334,8 @@ def sanity_check(central_value: dict[str, str], local: dict[str, str], table):
     if not sanity:
         report_error(
             f"\t\tSanity check failed for {table}: Central: {central_name}, {central_ext_id} and Local: {local_name}, {local_ext_id}")
+        with SANITY_LOCK:
+            SANITY_FAILURES[table].add(local['uuid'])
 
     return sanity
 
@@ -519,16 +1344,47 @@ def has_default_name(table):
     return table in ['continent', 'subcontinent', 'country']
 
 
+def differs(*columns) -> str:
+    """
+    Condition restricting an alignment UPDATE to the rows it changes, takes one parameter per column.
+    """
+    return f"({', '.join(columns)}, archived) IS DISTINCT FROM ({', '.join(['%s'] * len(columns))}, FALSE)"
+
+
+def count_unchanged(table, count: int):
+    with UNCHANGED_LOCK:
+        UNCHANGED[table] += count
+
+
+def report_unchanged(table, central_uuid):
+    count_unchanged(table, 1)
+    logging.info(f"\t\tLocal item {central_uuid} holds the central values already, not updated",
+                 extra=event('unchanged', table=table))
+
+
 def report_error(param):
-    logging.error(param)
+    # errors.log is written from the error events by the audit log
+    logging.error(param, extra=event('error'))
     error_list.append(f'{param.strip()}\n')
 
 
 def main():
-    iterate_central()
+    # one connection for the whole run, each table is aligned in its own transaction
+    with connect(CONNECTION, autocommit=True) as conn:
+        if COMMAND == 'apply':
+            with open(PLAN_PATH, encoding='utf8') as f:
+                apply_plan(json.load(f), conn)
+        else:
+            indexes = preflight_indexes(conn)
+            try:
+                plan = iterate_central(conn)
+            finally:
+                drop_temporary_indexes(indexes, conn)
+    if COMMAND == 'plan':
+        with open(PLAN_PATH, 'w+', encoding='utf8') as f:
+            json.dump({'input': PATH, 'tables': plan}, f, indent=1, ensure_ascii=False)
+        logging.info(f"Wrote plan to {PLAN_PATH}")
     logging.info("All done")
-    with open('errors.log', 'w+') as f:
-        f.writelines(error_list)
 
 
 if __name__ == '__main__':
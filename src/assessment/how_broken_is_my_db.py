@@ -1,5 +1,7 @@
 # usage: how_broken_is_my_db.py [-h] [-H HOST] [-d DBNAME] [-u USERNAME]
 #                               [-p PASSWORD] [-P PORT] [-o OUTPUT]
+#                               [-m METRICS] [-f FLEET] [-j CONCURRENCY]
+#                               [-r REPORT] [-t CONNECT_TIMEOUT]
 #
 # options:
 #   -h, --help            show this help message and exit
@@ -12,24 +14,39 @@
 #                         password for user
 #   -P PORT, --port PORT  port to connect to
 #   -o OUTPUT, --output OUTPUT
-#                         path of the log file
+#                         path of the JSON lines audit log
+#   -m METRICS, --metrics METRICS
+#                         path of the run metrics, a Prometheus textfile if it
+#                         ends with .prom, JSON otherwise
+#   -f FLEET, --fleet FLEET
+#                         path of a file listing the databases to assess, one
+#                         per line: an optional name and a libpq connection
+#                         string
+#   -j CONCURRENCY, --concurrency CONCURRENCY
+#                         number of databases of the fleet assessed at once
+#   -r REPORT, --report REPORT
+#                         path of the consolidated JSON report of the fleet
+#   -t CONNECT_TIMEOUT, --connect-timeout CONNECT_TIMEOUT
+#                         seconds to wait for a connection to a database of the
+#                         fleet, unless its connection string sets
+#                         connect_timeout
 
 import argparse
+import asyncio
+import json
 import logging
 import os
+import sys
+import time
+from datetime import datetime, timezone
 
 import psycopg
+from psycopg.conninfo import conninfo_to_dict, make_conninfo
 from psycopg.rows import dict_row
 
-FORMAT = '%(message)s'
-
-logFormatter = logging.Formatter(FORMAT)
-rootLogger = logging.getLogger()
-
-consoleHandler = logging.StreamHandler()
-consoleHandler.setFormatter(logFormatter)
-rootLogger.addHandler(consoleHandler)
-rootLogger.setLevel(logging.DEBUG)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from audit_log import event, setup_audit_log
+from run_metrics import connect, connect_async, phase, setup_run_metrics
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-H", "--host", default=os.environ.get("HOST"), help="database server host or socket directory",
@@ -42,44 +59,175 @@ parser.add_argument("-u", "--username", default=os.environ.get("USERNAME"),
 parser.add_argument("-p", "--password", default=os.environ.get("PASSWORD"), help="password for user", action="store")
 
 parser.add_argument("-P", "--port", default=os.environ.get("PORT"), help="port to connect to", action="store")
-parser.add_argument("-o", "--output", default=os.environ.get("OUTPUT"), help="path of the log file", action="store")
+parser.add_argument("-o", "--output", default=os.environ.get("OUTPUT"), help="path of the JSON lines audit log",
+                    action="store")
+parser.add_argument("-m", "--metrics", default=os.environ.get("METRICS"),
+                    help="path of the run metrics, a Prometheus textfile if it ends with .prom, JSON otherwise",
+                    action="store")
+parser.add_argument("-f", "--fleet", default=os.environ.get("FLEET"),
+                    help="path of a file listing the databases to assess, one per line: an optional name and a libpq "
+                         "connection string", action="store")
+parser.add_argument("-j", "--concurrency", default=os.environ.get("CONCURRENCY", 8), type=int,
+                    help="number of databases of the fleet assessed at once", action="store")
+parser.add_argument("-r", "--report", default=os.environ.get("REPORT", "fleet_report.json"),
+                    help="path of the consolidated JSON report of the fleet", action="store")
+parser.add_argument("-t", "--connect-timeout", default=os.environ.get("CONNECT_TIMEOUT", 10), type=int,
+                    help="seconds to wait for a connection to a database of the fleet, unless its connection string "
+                         "sets connect_timeout", action="store")
 
 args, unknown = parser.parse_known_args()
 
 assert len(unknown) == 0
 
-
-fileHandler = logging.FileHandler(args.output)
-fileHandler.setFormatter(logFormatter)
-rootLogger.addHandler(fileHandler)
+# the report is the output of this script, so it stays on the console
+setup_audit_log(args.output, console_level=logging.INFO)
+setup_run_metrics(args.metrics, script='how_broken_is_my_db', host=args.host, dbname=args.dbname)
 
 CONNECTION = f"host={args.host} dbname={args.dbname} user={args.username} password={args.password} port={args.port}"
 
+TABLES = ['continent', 'subcontinent', 'country', 'region', 'district', 'community']
+
 
 def has_default_name(table):
     return table in ['continent', 'subcontinent', 'country']
 
 
+def duplicates_query(table) -> str:
+    name = 'defaultName' if has_default_name(table) else 'name'
+    # list duplicates in column externalid
+    return f"SELECT id, {name}, uuid, archived, centrally_managed, externalid  FROM {table} WHERE externalid IN (SELECT externalid FROM {table} GROUP BY externalid HAVING COUNT(*) > 1) ORDER BY externalid DESC "
+
+
 def report_duplicates():
     logging.info(f'Connecting to {CONNECTION}')
-    with psycopg.connect(CONNECTION) as conn:
-        for table in ['continent', 'subcontinent', 'country', 'region', 'district', 'community']:
+    with connect(CONNECTION) as conn:
+        for table in TABLES:
             cur = conn.cursor(row_factory=dict_row)
-            name = 'defaultName' if has_default_name(table) else 'name'
-            # list duplicates in column externalid
-            cur.execute(
-                f"SELECT id, {name}, uuid, archived, centrally_managed, externalid  FROM {table} WHERE externalid IN (SELECT externalid FROM {table} GROUP BY externalid HAVING COUNT(*) > 1) ORDER BY externalid DESC ")
-            rows = cur.fetchall()
+            with phase('duplicates', table):
+                cur.execute(duplicates_query(table))
+                rows = cur.fetchall()
             if len(rows) > 0:
                 logging.info(f'{table} has {len(rows)} duplicates')
                 for row in rows:
-                    logging.info(f'\t{table} {row}')
+                    logging.info(f'\t{table} {row}', extra=event('duplicate', table=table, uuid=row['uuid']))
             else:
                 logging.info(f'{table} has no duplicates')
 
 
+def read_targets(path) -> list[tuple[str, str]]:
+    """
+    Reads the databases of the fleet, e.g. "hamburg host=10.0.0.5 dbname=sormas_db user=sormas" per line.
+    Without a name the host and database name identify the instance, or its line number if the connection string is
+    malformed. Empty lines and lines starting with # are skipped.
+    """
+    targets = []
+    with open(path, encoding='utf8') as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            name, _, conninfo = line.partition(' ')
+            if '=' in name:
+                conninfo = line
+                try:
+                    params = conninfo_to_dict(conninfo)
+                    name = f"{params.get('host', '')}/{params.get('dbname', '')}"
+                except psycopg.Error:
+                    # assess reports the instance as failed
+                    name = f"line {number}"
+            targets.append((name, conninfo))
+    return targets
+
+
+def redact(conninfo) -> str:
+    params = conninfo_to_dict(conninfo)
+    params.pop('password', None)
+    return make_conninfo(**params)
+
+
+async def assess(name, conninfo, semaphore: asyncio.Semaphore) -> dict:
+    """
+    Counts the rows and lists the duplicates of every infrastructure table of one instance. Its score is the
+    percentage of infrastructure rows not sharing their external id with another row.
+    """
+    report = {'name': name, 'target': None}
+    try:
+        # a malformed line fails its own instance only
+        report['target'] = redact(conninfo)
+        timeout = int(conninfo_to_dict(conninfo).get('connect_timeout') or args.connect_timeout)
+        if timeout <= 0:
+            raise ValueError(f"connect_timeout must be positive, got {timeout}")
+    except (psycopg.Error, ValueError) as e:
+        report.update(status='error', error=f"invalid connection string: {str(e).strip()}", score=None, seconds=0.0)
+        return report
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            # an unreachable host must not hold its slot for the TCP timeout of the OS
+            connecting = connect_async(conninfo, connect_timeout=timeout)
+            async with await asyncio.wait_for(connecting, timeout) as conn:
+                cur = conn.cursor(row_factory=dict_row)
+                tables, duplicates = {}, []
+                for table in TABLES:
+                    count = (await (await cur.execute(f"SELECT count(*) FROM {table}")).fetchone())['count']
+                    rows = await (await cur.execute(duplicates_query(table))).fetchall()
+                    tables[table] = {'rows': count, 'duplicates': len(rows),
+                                     'groups': len({row['externalid'] for row in rows})}
+                    duplicates += [dict(row, table=table) for row in rows]
+        except psycopg.Error as e:
+            report.update(status='error', error=str(e).strip(), score=None)
+            return report
+        except asyncio.TimeoutError:
+            report.update(status='error', error=f"connection timed out after {timeout} seconds", score=None)
+            return report
+        finally:
+            report['seconds'] = round(time.perf_counter() - start, 3)
+
+    total = sum(table['rows'] for table in tables.values())
+    score = round(100 * (1 - len(duplicates) / total), 2) if total else 100.0
+    report.update(status='ok', score=score, tables=tables, duplicates=duplicates)
+    return report
+
+
+async def assess_fleet(targets: list[tuple[str, str]]) -> list[dict]:
+    semaphore = asyncio.Semaphore(args.concurrency)
+    reports = []
+    for index, pending in enumerate(asyncio.as_completed([assess(name, conninfo, semaphore)
+                                                          for name, conninfo in targets])):
+        report = await pending
+        reports.append(report)
+        progress = event('assessed', table='fleet', index=index + 1, total=len(targets), instance=report['name'],
+                         score=report['score'])
+        if report['status'] == 'ok':
+            logging.info(f"{index + 1}/{len(targets)}: {report['name']} scores {report['score']}, "
+                         f"{len(report['duplicates'])} duplicates", extra=progress)
+        else:
+            logging.error(f"{index + 1}/{len(targets)}: {report['name']} failed: {report['error']}", extra=progress)
+    # failed instances first, then the worst scores
+    return sorted(reports, key=lambda report: (report['score'] is not None, report['score'] or 0, report['name']))
+
+
+def report_fleet():
+    targets = read_targets(args.fleet)
+    logging.info(f"Assessing {len(targets)} databases, {args.concurrency} at once")
+    with phase('fleet', items=len(targets)):
+        reports = asyncio.run(assess_fleet(targets))
+    failed = sum(1 for report in reports if report['status'] != 'ok')
+    with open(args.report, 'w+', encoding='utf8') as f:
+        json.dump({
+            'generated': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'instances': len(reports),
+            'failed': failed,
+            'reports': reports,
+        }, f, indent=1, ensure_ascii=False, default=str)
+    logging.info(f"Wrote the report of {len(reports)} databases, {failed} failed, to {args.report}")
+
+
 def main():
-    report_duplicates()
+    if args.fleet:
+        report_fleet()
+    else:
+        report_duplicates()
 
 
 if __name__ == '__main__':
@@ -1,23 +1,16 @@
 import argparse
-import json
 import logging
 import os
 import random
+import sys
 import uuid
-import itertools
 
-import psycopg
 from psycopg.rows import dict_row
 
-FORMAT = '%(message)s'
-
-logFormatter = logging.Formatter(FORMAT)
-rootLogger = logging.getLogger()
-
-consoleHandler = logging.StreamHandler()
-consoleHandler.setFormatter(logFormatter)
-rootLogger.addHandler(consoleHandler)
-rootLogger.setLevel(logging.DEBUG)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from infra_store import load_store
+from audit_log import event, setup_audit_log
+from run_metrics import connect, phase, setup_run_metrics
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-H", "--host", default=os.environ.get("HOST"), help="database server host or socket directory",
@@ -32,16 +25,19 @@ parser.add_argument("-p", "--password", default=os.environ.get("PASSWORD"), help
 parser.add_argument("-P", "--port", default=os.environ.get("PORT"), help="port to connect to", action="store")
 parser.add_argument("-i", "--input", default=os.environ.get("input"), help="path where to expect the central data",
                     action="store")
-parser.add_argument("-o", "--output", default=os.environ.get("OUTPUT"), help="path of the log file", action="store")
+parser.add_argument("-o", "--output", default=os.environ.get("OUTPUT"), help="path of the JSON lines audit log",
+                    action="store")
 parser.add_argument("-b", "--begin", default=os.environ.get("BEGIN"), help="uuid from where to start", action="store")
+parser.add_argument("-m", "--metrics", default=os.environ.get("METRICS"),
+                    help="path of the run metrics, a Prometheus textfile if it ends with .prom, JSON otherwise",
+                    action="store")
 
 args, unknown = parser.parse_known_args()
 
 assert len(unknown) == 0
 
-fileHandler = logging.FileHandler(args.output)
-fileHandler.setFormatter(logFormatter)
-rootLogger.addHandler(fileHandler)
+setup_audit_log(args.output)
+setup_run_metrics(args.metrics, script='infra_db_cleaner_2000', host=args.host, dbname=args.dbname)
 
 CONNECTION = f"host={args.host} dbname={args.dbname} user={args.username} password={args.password} port={args.port}"
 
@@ -50,33 +46,29 @@ def invalidate_centrally_managed_data():
     rnd = random.Random()
     rnd.seed(43)
 
-    with open(args.input) as f:
-        entities: list = json.load(f)
-        sorted_list = list(sorted(entities, key=lambda kv: kv['key']))
-        length = len(sorted_list)
-        assert length == 13372
+    with phase('load', 'community'):
+        store = load_store(args.input)
+    length = len(store)
+    assert length == 13372
 
-    begin_item = list(filter(lambda x: x['key'] == args.begin, sorted_list))
-    if len(begin_item) != 1:
+    # the store is sorted by uuid, so the position of the begin item splits the head from the tail
+    diff_length = store.position(args.begin)
+    if diff_length is None:
         raise Exception(f"Begin item {args.begin} not found")
 
-    tail_list = list(itertools.dropwhile(lambda x: x['key'] != args.begin, sorted_list))
-
-    diff_length = length - len(tail_list)
-
-    head_list = sorted_list[:diff_length]
+    tail_list = store.values[diff_length:]
 
-    assert len(head_list) + len(tail_list) == 13372
-    assert tail_list[0]['key'] == begin_item[0]['key']
+    assert tail_list[0]['uuid'] == args.begin
 
     logging.info(f"Dropped {diff_length} items")
     logging.info(f'Connecting to {CONNECTION}')
-    with psycopg.connect(CONNECTION) as conn:
+    with connect(CONNECTION) as conn, phase('invalidate', 'community', items=len(tail_list)):
         cur = conn.cursor(row_factory=dict_row)
 
         for index, entity in enumerate(tail_list):
-            logging.info(f"{index + diff_length + 1}/{length}: Processing {entity['value']}")
-            entity = entity['value']
+            logging.info(f"{index + diff_length + 1}/{length}: Processing {entity}",
+                         extra=event('processing', table='community', index=index + diff_length + 1, total=length,
+                                     uuid=entity['uuid']))
             # generate a new uuid for the record
             new_uuid = str(uuid.UUID(int=rnd.getrandbits(128), version=4))
             # update the record with the new uuid, archive it, and invalidate the name and the external id
@@ -89,7 +81,7 @@ def invalidate_centrally_managed_data():
                 (entity['name'] + '_INVALID', entity['externalID'] + '_INVALID_' + str(index), entity['uuid']))
 
             update = cur.fetchone()
-            logging.info(f'updated row to {update}')
+            logging.info(f'updated row to {update}', extra=event('updated', table='community', uuid=new_uuid))
 
 
 def main():
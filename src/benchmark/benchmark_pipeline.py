@@ -0,0 +1,186 @@
+#
+# usage: benchmark_pipeline.py [-h] [-s SCALES] [-b BASELINE] [-T THRESHOLD]
+#                              [-U]
+#
+# options:
+#   -h, --help            show this help message and exit
+#   -s SCALES, --scales SCALES
+#                         comma separated multiples of the real community count
+#   -b BASELINE, --baseline BASELINE
+#                         path of the stored baseline
+#   -T THRESHOLD, --threshold THRESHOLD
+#                         allowed relative regression against the baseline
+#   -U, --update-baseline
+#                         store the measurements as the new baseline
+
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, ROOT)
+
+import main as generator  # noqa: E402
+
+FORMAT = '%(message)s'
+
+GERMANY = os.path.join(ROOT, 'in', 'germany')
+REGIONS = 'sormas_bundeslaender_master.csv'
+DISTRICTS = 'sormas_landkreise_master.csv'
+COMMUNITIES = 'sormas_gemeinden_master.csv'
+
+
+def synthesize(directory, scale):
+    """
+    Writes the real regions and districts and scale copies of every real community into directory.
+    The copies keep their district, but get distinct names and external ids.
+    """
+    for name in (REGIONS, DISTRICTS):
+        with open(os.path.join(GERMANY, name), 'r') as src, open(os.path.join(directory, name), 'w') as dst:
+            dst.write(src.read())
+
+    with open(os.path.join(GERMANY, COMMUNITIES), 'r') as src, \
+            open(os.path.join(directory, COMMUNITIES), 'w', newline='') as dst:
+        reader = csv.DictReader(src, delimiter=';')
+        writer = csv.DictWriter(dst, fieldnames=reader.fieldnames, delimiter=';')
+        writer.writeheader()
+        rows = list(reader)
+        for copy in range(scale):
+            for row in rows:
+                if copy:
+                    row = dict(row, name=f"{row['name']} {copy}", externalID=f"{row['externalID']}{copy:03d}")
+                writer.writerow(row)
+        return len(rows) * scale
+
+
+def ref_indexes_for(directory):
+    regions, _ = generator.read_csv(os.path.join(directory, REGIONS), ';')
+    districts, _ = generator.read_csv(os.path.join(directory, DISTRICTS), ';')
+    return {'region': generator.build_ref_index(regions), 'district': generator.build_ref_index(districts)}
+
+
+def measure(stage, prepare):
+    """
+    Runs stage(prepare()) twice: once for the wall time, once under tracemalloc for the peak memory of the stage.
+    Preparing the input is not part of the measurement.
+    """
+    argument = prepare()
+    start = time.perf_counter()
+    stage(argument)
+    seconds = time.perf_counter() - start
+
+    argument = prepare()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before, _ = tracemalloc.get_traced_memory()
+    stage(argument)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'seconds': round(seconds, 4), 'peak_bytes': peak - before}
+
+
+def run_scale(scale):
+    with tempfile.TemporaryDirectory() as directory:
+        rows = synthesize(directory, scale)
+        in_path = os.path.join(directory, COMMUNITIES)
+        out_path = os.path.join(directory, 'community')
+        ref_indexes = ref_indexes_for(directory)
+
+        def read():
+            return generator.read_csv(in_path, ';')
+
+        def materialized():
+            entities, fieldnames = read()
+            return list(entities), fieldnames
+
+        def resolved():
+            entities, fieldnames = materialized()
+            problems = list()
+            for key in ('region', 'district'):
+                entities = generator.make_ref_dtos(entities, key, ref_indexes[key], problems)
+            return list(entities), [f for f in fieldnames if f not in ('region', 'district')]
+
+        def consume(rows_):
+            for _ in rows_:
+                pass
+
+        def resolve(entities):
+            entities, _ = entities
+            problems = list()
+            for key in ('region', 'district'):
+                entities = generator.make_ref_dtos(entities, key, ref_indexes[key], problems)
+            consume(entities)
+            assert not problems, problems
+
+        results = {
+            'read_csv': measure(lambda e: consume(e[0]), read),
+            'make_ref_dtos': measure(resolve, materialized),
+            'write_csv': measure(lambda e: consume(generator.write_csv(e, out_path + '.csv')), materialized),
+            'write_json': measure(lambda e: generator.write_json(e, out_path + '.json', dict()), resolved),
+            'store': measure(lambda e: generator.store(e, out_path, ref_indexes), read),
+        }
+        logging.info(f"{scale}x ({rows} communities):")
+        for stage, result in results.items():
+            logging.info(f"\t{stage:<14} {result['seconds']:>9.3f} s {result['peak_bytes'] / 2 ** 20:>9.1f} MiB")
+        return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for scale, stages in results.items():
+        for stage, result in stages.items():
+            reference = baseline.get(scale, {}).get(stage)
+            if not reference:
+                continue
+            for metric in ('seconds', 'peak_bytes'):
+                if reference[metric] and result[metric] > reference[metric] * (1 + threshold):
+                    regressions.append(f"{scale}x {stage} {metric}: {result[metric]} > {reference[metric]} "
+                                       f"(+{threshold:.0%} allowed)")
+    return regressions
+
+
+def main():
+    logFormatter = logging.Formatter(FORMAT)
+    rootLogger = logging.getLogger()
+    consoleHandler = logging.StreamHandler()
+    consoleHandler.setFormatter(logFormatter)
+    rootLogger.addHandler(consoleHandler)
+    rootLogger.setLevel(logging.DEBUG)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--scales", default=os.environ.get("SCALES", "1,10,100"),
+                        help="comma separated multiples of the real community count", action="store")
+    parser.add_argument("-b", "--baseline", default=os.path.join(os.path.dirname(__file__), 'baseline.json'),
+                        help="path of the stored baseline", action="store")
+    parser.add_argument("-T", "--threshold", default=0.5, type=float,
+                        help="allowed relative regression against the baseline", action="store")
+    parser.add_argument("-U", "--update-baseline", action="store_true",
+                        help="store the measurements as the new baseline")
+    args = parser.parse_args()
+
+    results = {scale: run_scale(int(scale)) for scale in args.scales.split(',')}
+
+    if args.update_baseline or not os.path.exists(args.baseline):
+        with open(args.baseline, 'w+') as f:
+            json.dump(results, f, indent=2)
+        logging.info(f"Stored baseline in {args.baseline}")
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        logging.error(regression)
+    if regressions:
+        sys.exit(1)
+    logging.info("No regressions")
+
+
+if __name__ == '__main__':
+    main()
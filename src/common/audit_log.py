@@ -0,0 +1,120 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+
+def event(kind: str, **fields) -> dict:
+    """
+    Extra of a log call marking it as an audit event, e.g. logging.info(msg, extra=event('updated', table=table)).
+    Events carrying index and total drive the progress line.
+    """
+    return {'audit': {'event': kind, **fields}}
+
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        line = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'thread': record.threadName,
+            'message': record.getMessage().strip(),
+        }
+        line.update(getattr(record, 'audit', {}))
+        return json.dumps(line, ensure_ascii=False, default=str)
+
+
+class StrippedFormatter(logging.Formatter):
+    def format(self, record):
+        return record.getMessage().strip()
+
+
+class ProgressHandler(logging.Handler):
+    """
+    Console handler printing records from console_level on as they come, and otherwise only a progress line with the
+    counts of the events seen so far, at most once per interval seconds.
+    """
+
+    def __init__(self, stream=None, interval=1.0, console_level=logging.WARNING):
+        super().__init__()
+        self.stream = stream or sys.stderr
+        self.interval = interval
+        self.console_level = console_level
+        self.tty = self.stream.isatty()
+        self.counters = Counter()
+        self.position = None
+        self.last = 0.0
+        self.pending = False
+
+    def emit(self, record):
+        fields = getattr(record, 'audit', {})
+        if 'event' in fields:
+            self.counters[fields['event']] += 1
+        if 'total' in fields:
+            self.position = f"{fields.get('table', '')} {fields['index']}/{fields['total']}".strip()
+        if record.levelno >= self.console_level:
+            self._write(record.getMessage() + '\n')
+        self.pending = True
+        now = time.monotonic()
+        if now - self.last >= self.interval:
+            self.flush_progress()
+            self.last = now
+
+    def _write(self, text):
+        if self.tty:
+            text = '\r\033[K' + text
+        self.stream.write(text)
+        self.stream.flush()
+
+    def flush_progress(self):
+        if not self.pending:
+            return
+        counters = ' | '.join(f"{kind} {count}" for kind, count in sorted(self.counters.items()))
+        line = ' | '.join(part for part in (self.position, counters) if part)
+        self._write(line if self.tty else line + '\n')
+        self.pending = False
+
+    def close(self):
+        self.flush_progress()
+        if self.tty:
+            self.stream.write('\n')
+        super().close()
+
+
+def setup_audit_log(path: str, errors_path: str = None, interval: float = 1.0,
+                    console_level=logging.WARNING) -> ProgressHandler:
+    """
+    Routes the root logger through a queue to a background thread writing the JSON lines audit log at path,
+    the progress line on the console and, if errors_path is given, the message of every error to errors_path.
+    """
+    # appended to, a resumed run continues the audit of the interrupted one
+    audit = logging.FileHandler(path, mode='a', encoding='utf8')
+    audit.setFormatter(JsonLinesFormatter())
+    progress = ProgressHandler(interval=interval, console_level=console_level)
+    handlers = [audit, progress]
+    if errors_path:
+        errors = logging.FileHandler(errors_path, mode='w', encoding='utf8')
+        errors.setLevel(logging.ERROR)
+        errors.setFormatter(StrippedFormatter())
+        handlers.append(errors)
+
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(logging.DEBUG)
+    listener.start()
+
+    def stop():
+        listener.stop()
+        for handler in handlers:
+            handler.close()
+
+    # runs before logging's own shutdown, so every queued record is written
+    atexit.register(stop)
+    return progress
@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import functools
+import gzip
+import json
+from collections import defaultdict
+
+CENTRAL_PATHS = {
+    'continent': 'international/continent.json',
+    'subcontinent': 'international/subcontinent.json',
+    'country': 'germany/country.json',
+    'region': 'germany/region.json',
+    'district': 'germany/district.json',
+    'community': 'germany/community.json',
+}
+
+
+def _name(value: dict) -> str:
+    return value['name'] if 'name' in value else value.get('defaultName')
+
+
+def _external_id(value: dict) -> str:
+    return value['externalId'] if value.get('externalId') else value.get('externalID')
+
+
+class InfraStore:
+    """
+    Read-only store of the central records of one table, sorted by uuid.
+    Each index maps a key to the positions of the records carrying it, so every lookup is a dict access.
+    """
+
+    def __init__(self, values):
+        self.values: list[dict] = sorted(values, key=lambda value: value['uuid'])
+        self.by_uuid: dict[str, int] = {}
+        self.by_name: dict[str, list[int]] = defaultdict(list)
+        self.by_external_id: dict[str, list[int]] = defaultdict(list)
+        self.by_iso_code: dict[str, list[int]] = defaultdict(list)
+        self.by_uno_code: dict[str, list[int]] = defaultdict(list)
+        self.by_parent: dict[str, list[int]] = defaultdict(list)
+
+        for position, value in enumerate(self.values):
+            self.by_uuid[value['uuid']] = position
+            self.by_name[_name(value)].append(position)
+            self.by_external_id[_external_id(value)].append(position)
+            if value.get('isoCode'):
+                self.by_iso_code[value['isoCode']].append(position)
+            if value.get('unoCode'):
+                self.by_uno_code[value['unoCode']].append(position)
+            for ref in value.values():
+                if isinstance(ref, dict) and 'uuid' in ref:
+                    self.by_parent[ref['uuid']].append(position)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def _resolve(self, index: dict[str, list[int]], key) -> list[dict]:
+        return [self.values[position] for position in index.get(key, ())]
+
+    def get(self, uuid: str) -> dict | None:
+        position = self.by_uuid.get(uuid)
+        return None if position is None else self.values[position]
+
+    def position(self, uuid: str) -> int | None:
+        return self.by_uuid.get(uuid)
+
+    def find_by_name(self, name: str) -> list[dict]:
+        return self._resolve(self.by_name, name)
+
+    def find_by_external_id(self, external_id: str) -> list[dict]:
+        return self._resolve(self.by_external_id, external_id)
+
+    def find_by_iso_code(self, iso_code: str) -> list[dict]:
+        return self._resolve(self.by_iso_code, iso_code)
+
+    def find_by_uno_code(self, uno_code) -> list[dict]:
+        return self._resolve(self.by_uno_code, uno_code)
+
+    def children_of(self, parent_uuid: str) -> list[dict]:
+        return self._resolve(self.by_parent, parent_uuid)
+
+    def names(self) -> dict[str, int]:
+        return {name: len(positions) for name, positions in self.by_name.items()}
+
+
+def _read_values(path: str):
+    if path.endswith('.json'):
+        with open(path, encoding='utf8') as f:
+            return [entity['value'] for entity in json.load(f)]
+    # the compact output of main.py, one value per line
+    with (gzip.open(path, 'rt', encoding='utf8') if path.endswith('.gz') else open(path, encoding='utf8')) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+@functools.lru_cache(maxsize=None)
+def load_store(path: str) -> InfraStore:
+    """
+    Loads the central data of one table from its .json, .ndjson or .ndjson.gz file, once per process.
+    """
+    return InfraStore(_read_values(path))
+
+
+def load_central(base: str, table: str) -> InfraStore:
+    return load_store(f'{base}/{CENTRAL_PATHS[table]}')
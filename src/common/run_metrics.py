@@ -0,0 +1,232 @@
+from __future__ import annotations
+
+import atexit
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import psycopg
+
+PREFIX = 'sormas_infra'
+
+
+def _counters():
+    return {'count': 0, 'rows': 0, 'seconds': 0.0}
+
+
+class RunMetrics:
+    """
+    Counters of one run: connections opened, statements by kind with the rows they affected or returned and their
+    time, and the wall time, central items and statements of every phase per table.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.labels: dict[str, str] = {}
+        self.started = time.time()
+        self.clock = time.perf_counter()
+        self.connections = 0
+        self.statements = defaultdict(_counters)
+        self.phases = {}
+        # phases are entered by the main thread, statements of worker threads count towards its current phase
+        self.stack = []
+
+    def connection(self):
+        with self.lock:
+            self.connections += 1
+
+    def statement(self, kind: str, count: int, rows: int, seconds: float):
+        with self.lock:
+            for counters in [self.statements[kind]] + self.stack[-1:]:
+                counters['count'] += count
+                counters['rows'] += max(rows, 0)
+                counters['seconds'] += seconds
+
+    @contextmanager
+    def phase(self, name: str, table: str = None, items: int = 0):
+        with self.lock:
+            current = self.phases.setdefault((name, table or ''), {**_counters(), 'items': 0, 'wall': 0.0})
+            current['items'] += items
+            self.stack.append(current)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                current['wall'] += time.perf_counter() - start
+                self.stack.remove(current)
+
+    def summary(self) -> dict:
+        seconds = time.perf_counter() - self.clock
+        with self.lock:
+            statements = {kind: dict(counters) for kind, counters in sorted(self.statements.items())}
+            phases = [{
+                'phase': name,
+                'table': table,
+                'seconds': round(counters['wall'], 3),
+                'items': counters['items'],
+                'statements': counters['count'],
+                'rows': counters['rows'],
+                'statement_seconds': round(counters['seconds'], 3),
+                'items_per_second': round(counters['items'] / counters['wall'], 1) if counters['wall'] else None,
+                'rows_per_second': round(counters['rows'] / counters['wall'], 1) if counters['wall'] else None,
+            } for (name, table), counters in self.phases.items()]
+        for counters in statements.values():
+            counters['seconds'] = round(counters['seconds'], 3)
+        rows = sum(counters['rows'] for counters in statements.values())
+        return {
+            'labels': self.labels,
+            'started': datetime.fromtimestamp(self.started, timezone.utc).isoformat(timespec='seconds'),
+            'seconds': round(seconds, 3),
+            'connections': self.connections,
+            'statements': statements,
+            'rows': rows,
+            'rows_per_second': round(rows / seconds, 1) if seconds else None,
+            'phases': phases,
+        }
+
+    def prometheus(self) -> str:
+        """
+        The summary in the text format of the node exporter's textfile collector.
+        """
+        summary = self.summary()
+        lines = []
+
+        def metric(name, kind, help_, samples):
+            lines.append(f'# HELP {PREFIX}_{name} {help_}')
+            lines.append(f'# TYPE {PREFIX}_{name} {kind}')
+            for labels, value in samples:
+                labels = ','.join(f'{key}="{_escape(value_)}"' for key, value_ in {**self.labels, **labels}.items())
+                lines.append(f'{PREFIX}_{name}{{{labels}}} {value}')
+
+        metric('run_started_timestamp_seconds', 'gauge', 'Start of the run', [({}, round(self.started, 3))])
+        metric('run_seconds', 'gauge', 'Wall time of the run', [({}, summary['seconds'])])
+        metric('connections_total', 'counter', 'Database connections opened', [({}, summary['connections'])])
+        for key, name, help_ in (('count', 'statements_total', 'Statements executed'),
+                                 ('rows', 'statement_rows_total', 'Rows affected or returned by statements'),
+                                 ('seconds', 'statement_seconds_total', 'Time spent executing statements')):
+            metric(name, 'counter', help_, [({'kind': kind}, counters[key])
+                                            for kind, counters in summary['statements'].items()])
+        for key, name, kind, help_ in (('seconds', 'phase_seconds', 'gauge', 'Wall time of a phase'),
+                                       ('items', 'phase_items_total', 'counter', 'Central items handled by a phase'),
+                                       ('statements', 'phase_statements_total', 'counter', 'Statements of a phase'),
+                                       ('rows', 'phase_rows_total', 'counter', 'Rows affected or returned in a phase')):
+            metric(name, kind, help_, [({'phase': phase_['phase'], 'table': phase_['table']}, phase_[key])
+                                       for phase_ in summary['phases']])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str):
+        # written to a temporary file first, the textfile collector must never read a partial file
+        with open(path + '.tmp', 'w+', encoding='utf8') as f:
+            if path.endswith('.prom'):
+                f.write(self.prometheus())
+            else:
+                json.dump(self.summary(), f, indent=1)
+        os.replace(path + '.tmp', path)
+        logging.info(f"Wrote metrics to {path}")
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+METRICS = RunMetrics()
+
+
+def _kind(query, cur) -> str:
+    if isinstance(query, bytes):
+        query = query.decode('utf8')
+    elif not isinstance(query, str):
+        query = query.as_string(cur)
+    match = re.match(r'\s*(\w+)', query)
+    return match.group(1).upper() if match else 'OTHER'
+
+
+class MeteredCursor(psycopg.Cursor):
+    def execute(self, query, params=None, **kwargs):
+        start = time.perf_counter()
+        result = super().execute(query, params, **kwargs)
+        METRICS.statement(_kind(query, self), 1, self.rowcount, time.perf_counter() - start)
+        return result
+
+    def executemany(self, query, params_seq):
+        params_seq = list(params_seq)
+        start = time.perf_counter()
+        super().executemany(query, params_seq)
+        METRICS.statement(_kind(query, self), len(params_seq), self.rowcount, time.perf_counter() - start)
+
+    @contextmanager
+    def copy(self, statement):
+        start = time.perf_counter()
+        with super().copy(statement) as copy:
+            yield copy
+        METRICS.statement(_kind(statement, self), 1, self.rowcount, time.perf_counter() - start)
+
+
+class MeteredServerCursor(psycopg.ServerCursor):
+    def execute(self, query, params=None, **kwargs):
+        start = time.perf_counter()
+        result = super().execute(query, params, **kwargs)
+        # the rows are fetched later, they are counted when the cursor is closed
+        self.kind = _kind(query, self)
+        METRICS.statement(self.kind, 1, 0, time.perf_counter() - start)
+        return result
+
+    def close(self):
+        if not self.closed and getattr(self, 'kind', None):
+            METRICS.statement(self.kind, 0, self.rownumber or 0, 0.0)
+        super().close()
+
+
+def connect(conninfo: str, **kwargs) -> psycopg.Connection:
+    """
+    psycopg.connect, counting the connection and the statements of every cursor it creates.
+    """
+    conn = psycopg.connect(conninfo, **kwargs)
+    conn.cursor_factory = MeteredCursor
+    conn.server_cursor_factory = MeteredServerCursor
+    METRICS.connection()
+    return conn
+
+
+class AsyncMeteredCursor(psycopg.AsyncCursor):
+    async def execute(self, query, params=None, **kwargs):
+        start = time.perf_counter()
+        result = await super().execute(query, params, **kwargs)
+        METRICS.statement(_kind(query, self), 1, self.rowcount, time.perf_counter() - start)
+        return result
+
+
+async def connect_async(conninfo: str, **kwargs) -> psycopg.AsyncConnection:
+    """
+    psycopg.AsyncConnection.connect, counting like connect.
+    """
+    conn = await psycopg.AsyncConnection.connect(conninfo, **kwargs)
+    conn.cursor_factory = AsyncMeteredCursor
+    METRICS.connection()
+    return conn
+
+
+def phase(name: str, table: str = None, items: int = 0):
+    """
+    Context manager timing a phase of the run, e.g. with phase('align', table, items=len(values)).
+    The statements executed meanwhile are attributed to it.
+    """
+    return METRICS.phase(name, table, items)
+
+
+def setup_run_metrics(path: str | None, **labels) -> RunMetrics:
+    """
+    Labels the metrics of this run and, if path is given, writes them there when the process exits: in the Prometheus
+    text format if path ends with .prom, as JSON otherwise.
+    """
+    METRICS.labels.update({key: str(value) for key, value in labels.items()})
+    if path:
+        atexit.register(METRICS.write, path)
+    return METRICS
@@ -0,0 +1,197 @@
+#
+# usage: etcd_loader.py [-h] [-e ENDPOINT] [-u USERNAME] [-p PASSWORD]
+#                       [-C CACERT] [-i INPUT] [-x PREFIX] [-b BATCH_SIZE]
+#                       [-t TEST]
+#
+# options:
+#   -h, --help            show this help message and exit
+#   -e ENDPOINT, --endpoint ENDPOINT
+#                         etcd endpoint serving the v3 JSON gateway
+#   -u USERNAME, --username USERNAME
+#                         etcd user name
+#   -p PASSWORD, --password PASSWORD
+#                         password for user
+#   -C CACERT, --cacert CACERT
+#                         CA certificate to verify the endpoint
+#   -i INPUT, --input INPUT
+#                         path where to expect the central data
+#   -x PREFIX, --prefix PREFIX
+#                         key prefix of the central infrastructure data
+#   -b BATCH_SIZE, --batch-size BATCH_SIZE
+#                         number of operations per transaction
+#   -t TEST, --test TEST  test mode/dry run
+
+import argparse
+import base64
+import json
+import logging
+import os
+import ssl
+import sys
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from infra_store import CENTRAL_PATHS
+
+FORMAT = '%(message)s'
+
+
+def _b64(value: str) -> str:
+    return base64.b64encode(value.encode('utf8')).decode('ascii')
+
+
+def _unb64(value: str) -> str:
+    return base64.b64decode(value).decode('utf8')
+
+
+def prefix_end(prefix: str) -> str:
+    # etcd range end covering every key starting with prefix
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class EtcdGatewayClient:
+    """
+    Minimal client for the etcd v3 JSON gateway (/v3/kv/range, /v3/kv/txn).
+    """
+
+    def __init__(self, endpoint, username=None, password=None, cacert=None, page_size=1000):
+        self.endpoint = endpoint.rstrip('/')
+        self.page_size = page_size
+        self.context = ssl.create_default_context(cafile=cacert) if cacert else None
+        self.token = None
+        if username:
+            self.token = self._post('/v3/auth/authenticate', {'name': username, 'password': password})['token']
+
+    def _post(self, path, body):
+        request = urllib.request.Request(self.endpoint + path, data=json.dumps(body).encode('utf8'),
+                                         headers={'Content-Type': 'application/json'})
+        if self.token:
+            request.add_header('Authorization', self.token)
+        with urllib.request.urlopen(request, context=self.context) as response:
+            return json.load(response)
+
+    def get_prefix(self, prefix: str) -> dict[str, str]:
+        result = {}
+        key, end = prefix, prefix_end(prefix)
+        while True:
+            page = self._post('/v3/kv/range', {'key': _b64(key), 'range_end': _b64(end), 'limit': self.page_size})
+            kvs = page.get('kvs', [])
+            for kv in kvs:
+                result[_unb64(kv['key'])] = _unb64(kv.get('value', ''))
+            if not page.get('more') or not kvs:
+                return result
+            # continue right after the last key of this page
+            key = _unb64(kvs[-1]['key']) + '\0'
+
+    def txn(self, puts: dict[str, str], deletes: list[str]):
+        operations = [{'requestPut': {'key': _b64(k), 'value': _b64(v)}} for k, v in puts.items()]
+        operations += [{'requestDeleteRange': {'key': _b64(k)}} for k in deletes]
+        response = self._post('/v3/kv/txn', {'success': operations})
+        if not response.get('succeeded', True):
+            raise Exception(f"Transaction with {len(operations)} operations failed: {response}")
+
+
+class InMemoryEtcd:
+    """
+    Stand-in for EtcdGatewayClient keeping the keyspace in a dict, e.g. for tests of the diffing and batching.
+    """
+
+    def __init__(self, data=None):
+        self.data: dict[str, str] = dict(data or {})
+        self.transactions = 0
+
+    def get_prefix(self, prefix: str) -> dict[str, str]:
+        return {k: v for k, v in self.data.items() if k.startswith(prefix)}
+
+    def txn(self, puts: dict[str, str], deletes: list[str]):
+        self.transactions += 1
+        self.data.update(puts)
+        for key in deletes:
+            self.data.pop(key, None)
+
+
+def read_records(path):
+    with open(path, encoding='utf8') as f:
+        return {entity['key']: entity['value'] for entity in json.load(f)}
+
+
+def compute_diff(prefix: str, records: dict[str, dict], current: dict[str, str]):
+    """
+    Returns the keys to add, to change and to delete below prefix, values are compared as parsed JSON.
+    """
+    adds, changes = {}, {}
+    for uuid_, value in records.items():
+        key = prefix + uuid_
+        if key not in current:
+            adds[key] = json.dumps(value, ensure_ascii=False)
+        elif json.loads(current[key]) != value:
+            changes[key] = json.dumps(value, ensure_ascii=False)
+    deletes = [key for key in current if key.startswith(prefix) and key[len(prefix):] not in records]
+    return adds, changes, deletes
+
+
+def apply_diff(client, puts: dict[str, str], deletes: list[str], batch_size: int):
+    operations = [(key, value) for key, value in puts.items()] + [(key, None) for key in deletes]
+    for start in range(0, len(operations), batch_size):
+        batch = operations[start:start + batch_size]
+        client.txn({k: v for k, v in batch if v is not None}, [k for k, v in batch if v is None])
+    return (len(operations) + batch_size - 1) // batch_size
+
+
+def load(client, input_path, prefix, batch_size, dry_run=False, infra_types=None):
+    infra_types = infra_types or CENTRAL_PATHS
+    # one read of the whole keyspace, the tables are diffed against their part of it
+    current = client.get_prefix(prefix)
+    logging.info(f"Fetched {len(current)} keys below {prefix}")
+    summary = {}
+    for table, path in infra_types.items():
+        table_prefix = f"{prefix}{table}/"
+        records = read_records(os.path.join(input_path, path))
+        adds, changes, deletes = compute_diff(table_prefix, records, current)
+        logging.info(f"{table}: {len(adds)} added, {len(changes)} changed, {len(deletes)} deleted, "
+                     f"{len(records) - len(adds) - len(changes)} unchanged")
+        transactions = 0
+        if not dry_run:
+            transactions = apply_diff(client, {**adds, **changes}, deletes, batch_size)
+        summary[table] = {'added': len(adds), 'changed': len(changes), 'deleted': len(deletes),
+                          'transactions': transactions}
+    return summary
+
+
+def main():
+    logFormatter = logging.Formatter(FORMAT)
+    rootLogger = logging.getLogger()
+    consoleHandler = logging.StreamHandler()
+    consoleHandler.setFormatter(logFormatter)
+    rootLogger.addHandler(consoleHandler)
+    rootLogger.setLevel(logging.DEBUG)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-e", "--endpoint", default=os.environ.get("endpoint", "http://localhost:2379"),
+                        help="etcd endpoint serving the v3 JSON gateway", action="store")
+    parser.add_argument("-u", "--username", default=os.environ.get("username"), help="etcd user name",
+                        action="store")
+    parser.add_argument("-p", "--password", default=os.environ.get("password"), help="password for user",
+                        action="store")
+    parser.add_argument("-C", "--cacert", default=os.environ.get("cacert"),
+                        help="CA certificate to verify the endpoint", action="store")
+    parser.add_argument("-i", "--input", default=os.environ.get("input"), help="path where to expect the central data",
+                        action="store")
+    parser.add_argument("-x", "--prefix", default=os.environ.get("prefix", "/central/location/"),
+                        help="key prefix of the central infrastructure data", action="store")
+    parser.add_argument("-b", "--batch-size", default=os.environ.get("batch_size", 128), type=int,
+                        help="number of operations per transaction", action="store")
+    parser.add_argument("-t", "--test", default=os.environ.get("test"), help="test mode/dry run", action="store")
+
+    args, unknown = parser.parse_known_args()
+
+    assert len(unknown) == 0
+
+    logging.info(f'Connecting to {args.endpoint}')
+    client = EtcdGatewayClient(args.endpoint, args.username, args.password, args.cacert)
+    summary = load(client, args.input, args.prefix, args.batch_size, dry_run=args.test == 'true')
+    logging.info(json.dumps(summary))
+
+
+if __name__ == '__main__':
+    main()
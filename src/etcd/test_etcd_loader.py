@@ -0,0 +1,93 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from etcd_loader import InMemoryEtcd, apply_diff, compute_diff, load
+
+PREFIX = '/central/location/'
+
+
+def write_table(directory, path, count, name='Item'):
+    os.makedirs(os.path.dirname(os.path.join(directory, path)), exist_ok=True)
+    with open(os.path.join(directory, path), 'w', encoding='utf8') as f:
+        json.dump([{'key': f'{index:05d}', 'value': {'uuid': f'{index:05d}', 'name': f'{name} {index}'}}
+                   for index in range(count)], f)
+
+
+class LoadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.infra_types = {'region': 'germany/region.json', 'community': 'germany/community.json'}
+        write_table(self.directory.name, 'germany/region.json', 500)
+        write_table(self.directory.name, 'germany/community.json', 14000)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def load(self, client, batch_size=128):
+        return load(client, self.directory.name, PREFIX, batch_size, infra_types=self.infra_types)
+
+    def test_initial_load_is_batched(self):
+        client = InMemoryEtcd()
+        summary = self.load(client)
+        self.assertEqual(summary['region'], {'added': 500, 'changed': 0, 'deleted': 0, 'transactions': 4})
+        self.assertEqual(summary['community'], {'added': 14000, 'changed': 0, 'deleted': 0, 'transactions': 110})
+        self.assertEqual(client.transactions, 114)
+        self.assertEqual(len(client.data), 14500)
+        self.assertEqual(json.loads(client.data[PREFIX + 'community/00042']), {'uuid': '00042', 'name': 'Item 42'})
+
+    def test_second_run_is_idempotent(self):
+        client = InMemoryEtcd()
+        self.load(client)
+        data = dict(client.data)
+        summary = self.load(client)
+        self.assertEqual(client.transactions, 114)
+        self.assertEqual(client.data, data)
+        self.assertTrue(all(table == {'added': 0, 'changed': 0, 'deleted': 0, 'transactions': 0}
+                            for table in summary.values()))
+
+    def test_only_the_diff_is_applied(self):
+        client = InMemoryEtcd()
+        self.load(client)
+        # one value changed in etcd, the last 100 communities removed centrally, other prefixes stay untouched
+        write_table(self.directory.name, 'germany/community.json', 13900)
+        client.data[PREFIX + 'community/00010'] = json.dumps({'uuid': '00010', 'name': 'Renamed'})
+        client.data['/other/key'] = 'kept'
+        summary = self.load(client)
+        self.assertEqual(summary['community'], {'added': 0, 'changed': 1, 'deleted': 100, 'transactions': 1})
+        self.assertEqual(summary['region']['transactions'], 0)
+        self.assertNotIn(PREFIX + 'community/13950', client.data)
+        self.assertEqual(json.loads(client.data[PREFIX + 'community/00010'])['name'], 'Item 10')
+        self.assertEqual(client.data['/other/key'], 'kept')
+
+    def test_dry_run_writes_nothing(self):
+        client = InMemoryEtcd()
+        summary = load(client, self.directory.name, PREFIX, 128, dry_run=True, infra_types=self.infra_types)
+        self.assertEqual(summary['community']['added'], 14000)
+        self.assertEqual(client.transactions, 0)
+        self.assertEqual(client.data, {})
+
+
+class DiffTest(unittest.TestCase):
+
+    def test_values_are_compared_as_json(self):
+        current = {PREFIX + 'a': '{"name": "A", "uuid": "a"}', PREFIX + 'b': '{"uuid": "b"}'}
+        adds, changes, deletes = compute_diff(PREFIX, {'a': {'uuid': 'a', 'name': 'A'}, 'c': {'uuid': 'c'}}, current)
+        self.assertEqual(list(adds), [PREFIX + 'c'])
+        self.assertEqual(changes, {})
+        self.assertEqual(deletes, [PREFIX + 'b'])
+
+    def test_puts_and_deletes_share_batches(self):
+        client = InMemoryEtcd({'x': '1', 'y': '2'})
+        transactions = apply_diff(client, {'a': '1', 'b': '2', 'c': '3'}, ['x', 'y'], 2)
+        self.assertEqual(transactions, 3)
+        self.assertEqual(client.transactions, 3)
+        self.assertEqual(client.data, {'a': '1', 'b': '2', 'c': '3'})
+
+
+if __name__ == '__main__':
+    unittest.main()
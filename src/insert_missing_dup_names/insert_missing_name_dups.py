@@ -1,31 +1,20 @@
 import os
+import sys
 
-from collections import defaultdict
 from datetime import datetime
 
-import psycopg
-import json
 import argparse
 
 import logging
 
 from psycopg.rows import dict_row
 
-error_list = []
-
-FORMAT = '%(message)s'
-
-logFormatter = logging.Formatter(FORMAT)
-rootLogger = logging.getLogger()
-
-fileHandler = logging.FileHandler("output.log")
-fileHandler.setFormatter(logFormatter)
-rootLogger.addHandler(fileHandler)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from infra_store import load_central
+from audit_log import event, setup_audit_log
+from run_metrics import connect, phase, setup_run_metrics
 
-consoleHandler = logging.StreamHandler()
-consoleHandler.setFormatter(logFormatter)
-rootLogger.addHandler(consoleHandler)
-rootLogger.setLevel(logging.DEBUG)
+error_list = []
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-H", "--host", default=os.environ.get("host"), help="database server host or socket directory",
@@ -39,11 +28,19 @@ parser.add_argument("-u", "--username", default=os.environ.get("username"),
 parser.add_argument("-p", "--password", default=os.environ.get("password"), help="password for user", action="store")
 parser.add_argument("-i", "--input", default=os.environ.get("input"), help="path where to expect the central data",
                     action="store")
+parser.add_argument("-l", "--audit-log", default=os.environ.get("audit_log", "audit.jsonl"),
+                    help="path of the JSON lines audit log", action="store")
+parser.add_argument("-m", "--metrics", default=os.environ.get("metrics"),
+                    help="path of the run metrics, a Prometheus textfile if it ends with .prom, JSON otherwise",
+                    action="store")
 
 args, unknown = parser.parse_known_args()
 
 assert len(unknown) == 0
 
+setup_audit_log(args.audit_log)
+setup_run_metrics(args.metrics, script='insert_missing_name_dups', host=args.host, dbname=args.dbname)
+
 CONNECTION = f"host={args.host} dbname={args.dbname} user={args.username} password={args.password} port={args.port}"
 logging.info(f'Connecting to {args.host}')
 PATH = args.input
@@ -52,9 +49,10 @@ NUMBER_OF_NAMES: dict[str, int] = {}
 
 
 def insert_missing(group):
-    with psycopg.connect(CONNECTION) as conn:
+    with connect(CONNECTION) as conn:
         with conn.cursor(row_factory=dict_row) as cur:
             present_communities = cur.execute("SELECT * FROM community WHERE name = %s", (group[0],)).fetchall()
+            by_district = {community['district']['uuid']: community for community in group[1]}
 
             for present_community in present_communities:
                 district_id = present_community['district_id']
@@ -62,12 +60,13 @@ def insert_missing(group):
                 district = cur.execute("SELECT uuid,name FROM district WHERE id = %s", (district_id,)).fetchone()
                 assert district is not None
                 # find the community in the group that has the same district
-                community = next(filter(lambda x: x['district']['uuid'] == district['uuid'], group[1]), None)
+                community = by_district.get(district['uuid'])
                 assert community is not None
                 # update the uuid of the present community
                 cur.execute("UPDATE community SET uuid = %s WHERE id = %s",
                             (community['uuid'], present_community['id']))
-                logging.info(f"Updated community {present_community} in district {district['name']} to uuid {community['uuid']}")
+                logging.info(f"Updated community {present_community} in district {district['name']} to uuid {community['uuid']}",
+                             extra=event('updated', table='community', uuid=community['uuid']))
 
             # insert the remaining communities
             for community in group[1]:
@@ -90,20 +89,19 @@ def insert_missing(group):
                     (id, changedate, creationdate, name, uuid, district_id, archived, externalid,  centrally_managed, sys_period) 
                     values ('{max_id + 1}','{date}', '{date}', %s, '{community['uuid']}', {district_id}, false, {external_id},true, '["{date}",)');
                     """, (name,))
-                    logging.info(f"Inserted central value: {community}")
+                    logging.info(f"Inserted central value: {community}",
+                                 extra=event('inserted', table='community', uuid=community['uuid']))
 
 
 def main():
-    community_path = f'{PATH}/germany/community.json'
-    with open(community_path) as f:
-        community_values = map(lambda x: x['value'], json.load(f))
-        # group community values by name
-        grouped_by_name = defaultdict(list)
-        for community in community_values:
-            grouped_by_name[community['name']].append(community)
-
-        groups = list(filter(lambda x: len(x[1]) > 1, grouped_by_name.items()))
-        for group in groups:
+    with phase('load', 'community'):
+        store = load_central(PATH, 'community')
+    # the communities sharing their name with others
+    groups = [(name, store.find_by_name(name)) for name, count in store.names().items() if count > 1]
+    with phase('insert_missing', 'community', items=len(groups)):
+        for index, group in enumerate(groups):
+            logging.info(f"{index + 1}/{len(groups)}: Processing {group[0]}",
+                         extra=event('processing', table='community', index=index + 1, total=len(groups)))
             insert_missing(group)
 
 
@@ -1,6 +1,7 @@
 #
 # usage: central_verifier.py [-h] [-H HOST] [-d DBNAME] [-u USERNAME]
-#                           [-p PASSWORD] [-P PORT] [-i INPUT]
+#                           [-p PASSWORD] [-P PORT] [-i INPUT] [-l AUDIT_LOG]
+#                           [-m METRICS]
 #
 # options:
 #  -h, --help            show this help message and exit
@@ -14,29 +15,24 @@
 #  -P PORT, --port PORT  db portr
 #  -i INPUT, --input INPUT
 #                        path where to expect the central data community
+#  -l AUDIT_LOG, --audit-log AUDIT_LOG
+#                        path of the JSON lines audit log
+#  -m METRICS, --metrics METRICS
+#                        path of the run metrics, a Prometheus textfile if it
+#                        ends with .prom, JSON otherwise
 
 import argparse
-import json
 import logging
 import os
+import sys
 from datetime import datetime
 
-import psycopg
 from psycopg.rows import dict_row
 
-FORMAT = '%(message)s'
-
-logFormatter = logging.Formatter(FORMAT)
-rootLogger = logging.getLogger()
-
-fileHandler = logging.FileHandler("output.log")
-fileHandler.setFormatter(logFormatter)
-rootLogger.addHandler(fileHandler)
-
-consoleHandler = logging.StreamHandler()
-consoleHandler.setFormatter(logFormatter)
-rootLogger.addHandler(consoleHandler)
-rootLogger.setLevel(logging.DEBUG)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from infra_store import load_store
+from audit_log import event, setup_audit_log
+from run_metrics import connect, phase, setup_run_metrics
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-H", "--host", default=os.environ.get("host"), help="database server host or socket directory",
@@ -51,11 +47,19 @@ parser.add_argument("-P", "--port", default=os.environ.get("port"), help="db por
 parser.add_argument("-i", "--input", default=os.environ.get("input"),
                     help="path where to expect the central data community",
                     action="store")
+parser.add_argument("-l", "--audit-log", default=os.environ.get("audit_log", "audit.jsonl"),
+                    help="path of the JSON lines audit log", action="store")
+parser.add_argument("-m", "--metrics", default=os.environ.get("metrics"),
+                    help="path of the run metrics, a Prometheus textfile if it ends with .prom, JSON otherwise",
+                    action="store")
 
 args, unknown = parser.parse_known_args()
 
 assert len(unknown) == 0
 
+setup_audit_log(args.audit_log)
+setup_run_metrics(args.metrics, script='central_verifier', host=args.host, dbname=args.dbname)
+
 CONNECTION = f"host={args.host} dbname={args.dbname} user={args.username} password={args.password} port={args.port}"
 logging.info(f'Connecting to {args.host}')
 PATH = args.input
@@ -63,19 +67,18 @@ PATH = args.input
 
 def verify():
     table = 'community'
-    with open(PATH) as f:
-        entities: list = json.load(f)
-
-    l = list(sorted(entities, key=lambda kv: kv['key']))
-    length = len(l)
-    for index, entity in enumerate(l):
-        central_value = entity['value']
-        name = central_value['name']
-        id_ = central_value['externalID']
-        uuid_ = central_value['uuid']
-        logging.info(f"{index + 1}/{length}: Processing {name}, {id_}, {uuid_}")
+    with phase('load', table):
+        store = load_store(PATH)
+    length = len(store)
+    with phase('verify', table, items=length):
+        for index, central_value in enumerate(store):
+            name = central_value['name']
+            id_ = central_value['externalID']
+            uuid_ = central_value['uuid']
+            logging.info(f"{index + 1}/{length}: Processing {name}, {id_}, {uuid_}",
+                         extra=event('processing', table=table, index=index + 1, total=length, uuid=uuid_))
 
-        verify_uuid(table, central_value)
+            verify_uuid(table, central_value)
 
 
 def insert_entity(table, central_value, conn):
@@ -98,11 +101,12 @@ def insert_entity(table, central_value, conn):
         (id, changedate, creationdate, name, uuid, district_id, archived, externalid,  centrally_managed, sys_period) 
         values ('{max_id + 1}','{date}', '{date}', %s, '{central_value['uuid']}', {district_id}, false, {external_id},true, '["{date}",)');
         """, (name,))
-        logging.info(f"Inserted central value: {central_value}")
+        logging.info(f"Inserted central value: {central_value}",
+                     extra=event('inserted', table=table, uuid=central_value['uuid']))
 
 
 def verify_uuid(table, central_value):
-    with psycopg.connect(CONNECTION) as conn:
+    with connect(CONNECTION) as conn:
         with conn.cursor(row_factory=dict_row) as cur:
             central_value_uuid = central_value['uuid']
             local = cur.execute(f"SELECT * FROM {table} WHERE uuid=%s", [central_value_uuid]).fetchone()
@@ -114,7 +118,8 @@ def verify_uuid(table, central_value):
 
             date = datetime.fromisoformat('2000-01-01').strftime("%Y-%m-%d %H:%M:%S")
             cur.execute(f"UPDATE {table} SET changedate='{date}' WHERE uuid='{central_value_uuid}';")
-            logging.info(f"\t\tUpdated changedate for {central_value_uuid}")
+            logging.info(f"\t\tUpdated changedate for {central_value_uuid}",
+                         extra=event('updated', table=table, uuid=central_value_uuid))
 
 
 def has_default_name(table):